@@ -4,11 +4,29 @@
 # Env vars:
 #   ADMIN_USER, ADMIN_PASS, FLASK_SECRET_KEY
 #   MAX_UPLOAD_BYTES (default 20GB)  e.g. export MAX_UPLOAD_BYTES=$((50*1024*1024*1024))
-
-from flask import Flask, request, redirect, session, jsonify, send_from_directory
+#   USAGE_RECONCILE_SECONDS (default 6h, 0 disables the background usage reconcile)
+#   SCAN_WORKERS (default 8), SCAN_TIMEOUT_SECONDS (default 5)  parallel admin usage scans
+#   JOURNAL_KEEP_VERSIONS (default 500)  tree changes kept for delta sync
+#   DISK_STATS_TTL (default 10 seconds, 0 disables)  shared disk usage cache
+#   UPLOAD_SESSION_TTL (default 24h)  idle resumable uploads are discarded after this
+#   UPLOAD_SESSIONS_PER_USER (default 4)  unfinished resumable uploads a user may have open
+#   UPLOAD_SLOTS (default 8)  folder upload chunks processed at once; more get 429 + Retry-After
+#   DEDUP_STORAGE (default false)  store identical uploads once, hardlinked into user folders
+#   DOWNLOAD_OFFLOAD (nginx | sendfile, default off), DOWNLOAD_ACCEL_PREFIX (default /_storage/)
+#     let the reverse proxy send file downloads once the app has checked them
+
+from flask import Flask, request, redirect, session, jsonify, make_response
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-import os, sqlite3, time, shutil
+from werkzeug.wsgi import wrap_file
+from werkzeug.http import is_resource_modified
+from werkzeug.exceptions import ClientDisconnected, RequestEntityTooLarge
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+import os, sqlite3, time, shutil, threading, json, secrets, tempfile, functools, tarfile, hashlib, zipfile, math
+import mimetypes, unicodedata
+from urllib.parse import quote
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 
 APP_TITLE = "Joey's Cloud"
 HOST = "0.0.0.0"
@@ -38,6 +56,51 @@ app.config.update(
 app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get("MAX_UPLOAD_BYTES", 20 * 1024 * 1024 * 1024))  # 20GB default
 app.config["MAX_FORM_MEMORY_SIZE"] = int(os.environ.get("MAX_FORM_MEMORY_SIZE", 64 * 1024 * 1024))  # 64MB in RAM
 
+# Usage ledger: periodic full rescan that corrects drift (files changed outside the app, crashes mid-upload)
+USAGE_RECONCILE_SECONDS = int(os.environ.get("USAGE_RECONCILE_SECONDS", 6 * 60 * 60))
+
+# Admin stats scan users that need a rescan in parallel; a scan that runs past the
+# timeout is reported as stale rather than holding up the response, and finishes in
+# the background.
+SCAN_WORKERS = max(1, int(os.environ.get("SCAN_WORKERS", 8)))
+SCAN_TIMEOUT_SECONDS = float(os.environ.get("SCAN_TIMEOUT_SECONDS", 5))
+
+# Delta tree sync: clients further behind than this many versions get a full reload
+JOURNAL_KEEP_VERSIONS = int(os.environ.get("JOURNAL_KEEP_VERSIONS", 500))
+
+# statvfs on network/FUSE volumes can be slow; all requests share one cached reading
+DISK_STATS_TTL = float(os.environ.get("DISK_STATS_TTL", 10))
+
+# Resumable uploads: partial files live here until finalized, or until idle this long
+UPLOADS_DIR = os.path.join(STORAGE_DIR, ".uploads")
+UPLOAD_SESSION_TTL = int(os.environ.get("UPLOAD_SESSION_TTL", 24 * 60 * 60))
+UPLOAD_SESSIONS_PER_USER = max(1, int(os.environ.get("UPLOAD_SESSIONS_PER_USER", 4)))
+os.makedirs(UPLOADS_DIR, exist_ok=True)
+UPLOAD_WRITE_BYTES = 1024 * 1024
+UPLOAD_PART_BYTES = 8 * 1024 * 1024  # fixed part size for parallel uploads
+
+# Folder upload chunks handled at once; past that the server answers 429 and the
+# browser backs off instead of piling more requests onto busy workers
+UPLOAD_SLOTS = max(1, int(os.environ.get("UPLOAD_SLOTS", 8)))
+UPLOAD_RETRY_AFTER = 1  # seconds, sent as Retry-After with the 429
+
+# Dedup mode: uploads are SHA-256'd while streaming and kept once under BLOBS_DIR;
+# user paths are hardlinks to the blob, and a blob goes when its last link does.
+# Needs user folders and BLOBS_DIR on one filesystem (otherwise files stay plain copies).
+DEDUP_STORAGE = os.environ.get("DEDUP_STORAGE", "false").lower() == "true"
+BLOBS_DIR = os.path.join(STORAGE_DIR, ".blobs")
+
+# Downloads honour Range requests; a request for more ranges than this gets the whole file
+DOWNLOAD_MAX_RANGES = 64
+DOWNLOAD_READ_BYTES = 1024 * 1024
+
+# Offloaded downloads: the app does the login and path checks, then the reverse proxy
+# sends the file itself, so no worker is held for the transfer.
+#   nginx    -> X-Accel-Redirect: DOWNLOAD_ACCEL_PREFIX + path under STORAGE_DIR (an internal location)
+#   sendfile -> X-Sendfile: absolute path (Apache mod_xsendfile, lighttpd)
+DOWNLOAD_OFFLOAD = os.environ.get("DOWNLOAD_OFFLOAD", "").lower()
+DOWNLOAD_ACCEL_PREFIX = "/" + os.environ.get("DOWNLOAD_ACCEL_PREFIX", "/_storage/").strip("/") + "/"
+
 # ---------------- DB ----------------
 
 def db():
@@ -49,6 +112,9 @@ def init_db():
     conn = db()
     cur = conn.cursor()
 
+    # WAL lets the stats endpoint read the ledger while uploads are writing it
+    cur.execute("PRAGMA journal_mode=WAL")
+
     cur.execute("""
     CREATE TABLE IF NOT EXISTS users (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -58,6 +124,71 @@ def init_db():
         created_at INTEGER NOT NULL
     )
     """)
+    # The file index is seeded by the same rescan that seeds a ledger row, so on the
+    # first start with the index, drop ledger rows to have every user reindexed.
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='files'")
+    if not cur.fetchone():
+        cur.execute("DROP TABLE IF EXISTS usage_ledger")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS files (
+        user_id INTEGER NOT NULL,
+        path TEXT NOT NULL,
+        parent TEXT NOT NULL,
+        name TEXT NOT NULL,
+        type TEXT NOT NULL,
+        size INTEGER NOT NULL DEFAULT 0,
+        mtime REAL NOT NULL DEFAULT 0,
+        hash TEXT,
+        PRIMARY KEY (user_id, path)
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_files_parent ON files (user_id, parent)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS tree_versions (
+        user_id INTEGER PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS tree_changes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        op TEXT NOT NULL,
+        path TEXT NOT NULL,
+        new_path TEXT,
+        type TEXT,
+        size INTEGER
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tree_changes_user ON tree_changes (user_id, version)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS usage_ledger (
+        user_id INTEGER PRIMARY KEY,
+        bytes INTEGER NOT NULL DEFAULT 0,
+        files INTEGER NOT NULL DEFAULT 0,
+        reconciled_at INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS upload_sessions (
+        id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        folder TEXT NOT NULL,
+        name TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        received INTEGER NOT NULL DEFAULT 0,
+        created_at INTEGER NOT NULL,
+        updated_at INTEGER NOT NULL
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS upload_parts (
+        session_id TEXT NOT NULL,
+        part INTEGER NOT NULL,
+        PRIMARY KEY (session_id, part)
+    )
+    """)
     conn.commit()
 
     cur.execute("SELECT id FROM users WHERE username=?", (DEFAULT_ADMIN_USERNAME,))
@@ -113,49 +244,194 @@ def sanitize_relpath(rel_path: str) -> str:
             safe_parts.append(sp)
     return "/".join(safe_parts)
 
-def folder_tree(root: str, rel: str = ""):
+def upload_target(base_folder: str, raw_rel: str):
+    """(rel_dir, rel_name) a folder upload writes `raw_rel` to, or None to skip it."""
+    rel = sanitize_relpath(raw_rel)  # keeps subfolders safely
+    if base_folder:
+        rel = f"{base_folder}/{rel}".strip("/")
+    rel_name = os.path.basename(rel)
+    rel_name = secure_filename(rel_name) or rel_name
+    return (os.path.dirname(rel), rel_name) if rel_name else None
+
+UPLOAD_TEMP_PREFIX = ".upload-"
+
+def is_upload_temp(name: str) -> bool:
+    """Half-written upload (StagedWrite, or adopt_blob's link temp): never listed, indexed or counted."""
+    return name.startswith(UPLOAD_TEMP_PREFIX) and name.endswith((".part", ".part.link"))
+
+def folder_tree(root: str, rel: str = "", depth: int = None):
+    """
+    Serialize a folder as nested dicts.
+
+    With depth=None the whole subtree is returned. Otherwise only `depth` levels get
+    "children"; every folder carries a "count" of its direct entries so the UI can
+    show an expander and fetch the next level on demand.
+    """
     base = safe_join(root, rel)
-    if not os.path.exists(base):
-        return {"name": "", "path": rel, "type": "folder", "children": []}
+    if not os.path.isdir(base):
+        return {"name": "", "path": rel, "type": "folder", "count": 0, "children": []}
 
-    def scan_dir(abs_path, rel_path):
-        node = {"name": os.path.basename(abs_path) if rel_path else "", "path": rel_path, "type": "folder", "children": []}
+    def count_entries(abs_path):
         try:
-            entries = sorted(os.listdir(abs_path), key=lambda s: s.lower())
-        except PermissionError:
+            with os.scandir(abs_path) as it:
+                return sum(1 for e in it if not is_upload_temp(e.name))
+        except OSError:
+            return 0
+
+    def scan_dir(abs_path, rel_path, levels):
+        node = {"name": os.path.basename(abs_path) if rel_path else "", "path": rel_path, "type": "folder"}
+        if levels is not None and levels <= 0:
+            node["count"] = count_entries(abs_path)
             return node
 
+        node["children"] = []
+        try:
+            with os.scandir(abs_path) as it:
+                entries = sorted((e for e in it if not is_upload_temp(e.name)), key=lambda e: e.name.lower())
+        except OSError:
+            entries = []
+        node["count"] = len(entries)
+
         for e in entries:
-            ap = os.path.join(abs_path, e)
-            rp = (rel_path + "/" + e).lstrip("/")
-            if os.path.isdir(ap):
-                node["children"].append(scan_dir(ap, rp))
+            rp = (rel_path + "/" + e.name).lstrip("/")
+            if e.is_dir():
+                node["children"].append(scan_dir(e.path, rp, None if levels is None else levels - 1))
             else:
                 try:
-                    size = os.path.getsize(ap)
+                    size = e.stat().st_size
                 except OSError:
                     size = 0
-                node["children"].append({"name": e, "path": rp, "type": "file", "size": size})
+                node["children"].append({"name": e.name, "path": rp, "type": "file", "size": size})
         return node
 
-    return scan_dir(base, rel)
+    return scan_dir(base, rel, depth)
 
-def dir_size_bytes(path: str) -> int:
-    total = 0
-    for r, _, files in os.walk(path):
-        for f in files:
-            fp = os.path.join(r, f)
-            try:
-                total += os.path.getsize(fp)
-            except OSError:
-                pass
-    return total
+STREAM_BUFFER_BYTES = 64 * 1024
+
+def iter_tree_json(root: str, rel: str = "", extra: dict = None):
+    """
+    folder_tree(root, rel) as JSON text, yielded in ~64KB pieces while walking.
+
+    Only one sorted listing per nesting level is held at a time, so memory follows
+    tree depth rather than tree size and the first bytes go out before the walk
+    finishes. `extra` keys are appended to the root object.
+    """
+    dumps = json.dumps
+    base = safe_join(root, rel)
+    if not os.path.isdir(base):
+        yield dumps(dict({"name": "", "path": rel, "type": "folder", "count": 0, "children": []}, **(extra or {})))
+        return
+
+    def walk(abs_path, rel_path, tail):
+        name = os.path.basename(abs_path) if rel_path else ""
+        yield '{"name":' + dumps(name) + ',"path":' + dumps(rel_path) + ',"type":"folder","children":['
+        try:
+            with os.scandir(abs_path) as it:
+                entries = sorted((e for e in it if not is_upload_temp(e.name)), key=lambda e: e.name.lower())
+        except OSError:
+            entries = []
+        for i, e in enumerate(entries):
+            if i:
+                yield ","
+            rp = (rel_path + "/" + e.name).lstrip("/")
+            if e.is_dir():
+                yield from walk(e.path, rp, "")
+            else:
+                try:
+                    size = e.stat().st_size
+                except OSError:
+                    size = 0
+                yield '{"name":' + dumps(e.name) + ',"path":' + dumps(rp) + ',"type":"file","size":%d}' % size
+        yield '],"count":%d%s}' % (len(entries), tail)
+
+    tail = "".join("," + dumps(k) + ":" + dumps(v) for k, v in (extra or {}).items())
+    buf = []
+    size = 0
+    for piece in walk(base, rel, tail):
+        buf.append(piece)
+        size += len(piece)
+        if size >= STREAM_BUFFER_BYTES:
+            yield "".join(buf)
+            buf = []
+            size = 0
+    if buf:
+        yield "".join(buf)
+
+TREE_FOLDER = 1   # compact_tree() flag bits
+TREE_LOADED = 2   # folder's children are included
+
+def compact_tree(node: dict) -> dict:
+    """
+    Re-encode a folder_tree()/index_tree() result as parallel arrays in pre-order.
 
-def count_files(path: str) -> int:
-    c = 0
-    for _, _, files in os.walk(path):
-        c += len(files)
-    return c
+    Nodes are listed parents first; "parent" holds each node's parent index (-1 for the
+    root), "name" its name and "flags" TREE_FOLDER/TREE_LOADED bits. "size" is a file's
+    size or a folder's entry count. Paths are not sent: the client joins names down
+    from "root", so deep trees no longer repeat every ancestor prefix and key name.
+    """
+    out = {"format": "compact", "root": node["path"], "parent": [], "name": [], "flags": [], "size": []}
+    stack = [(node, -1)]
+    while stack:
+        n, parent = stack.pop()
+        idx = len(out["name"])
+        out["parent"].append(parent)
+        out["name"].append(n["name"])
+        if n["type"] == "folder":
+            children = n.get("children")
+            out["flags"].append(TREE_FOLDER | (TREE_LOADED if children is not None else 0))
+            out["size"].append(n.get("count", 0))
+            # reversed so children pop off the stack in listing order
+            stack.extend((ch, idx) for ch in reversed(children or []))
+        else:
+            out["flags"].append(0)
+            out["size"].append(n.get("size", 0))
+    return out
+
+def scan_tree(path: str, entries: list = None, temps: list = None) -> dict:
+    """
+    Walk a tree once with os.scandir and total it up.
+
+    Returns {"bytes", "files", "dirs", "mtime"} where mtime is the newest file mtime.
+    Directory checks come from the readdir entry type and each file is stat'ed once
+    via the cached DirEntry.stat(), instead of a separate walk + getsize per metric.
+
+    If `entries` is a list, (rel_path, type, size, mtime) is appended for every file
+    and folder (folders cost one extra stat each), which is what the file index is
+    rebuilt from. Half-written uploads are left out; if `temps` is a list, their paths
+    are appended to it instead.
+    """
+    totals = {"bytes": 0, "files": 0, "dirs": 0, "mtime": 0}
+    stack = [(path, "")]
+    while stack:
+        abs_dir, rel_dir = stack.pop()
+        try:
+            it = os.scandir(abs_dir)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                if is_upload_temp(entry.name):
+                    if temps is not None:
+                        temps.append(entry.path)
+                    continue
+                rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        totals["dirs"] += 1
+                        stack.append((entry.path, rel))
+                        if entries is not None:
+                            entries.append((rel, "folder", 0, entry.stat(follow_symlinks=False).st_mtime))
+                        continue
+                    totals["files"] += 1
+                    st = entry.stat()
+                except OSError:
+                    continue
+                totals["bytes"] += st.st_size
+                if st.st_mtime > totals["mtime"]:
+                    totals["mtime"] = st.st_mtime
+                if entries is not None:
+                    entries.append((rel, "file", st.st_size, st.st_mtime))
+    return totals
 
 def fmt_bytes(n: int) -> str:
     units = ["B", "KB", "MB", "GB", "TB"]
@@ -165,9 +441,1012 @@ def fmt_bytes(n: int) -> str:
             return f"{x:.1f} {u}" if u != "B" else f"{int(x)} B"
         x /= 1024.0
 
-def disk_stats():
+disk_cache = {"stats": None, "at": 0.0, "refreshing": False}
+disk_cache_lock = threading.Lock()
+
+def read_disk_stats():
     usage = shutil.disk_usage(STORAGE_DIR)
-    return {"total": usage.total, "used": usage.used, "free": usage.free}
+    out = {"total": usage.total, "used": usage.used, "free": usage.free}
+    for k in ("total", "used", "free"):
+        out[k + "_h"] = fmt_bytes(out[k])
+    return out
+
+def refresh_disk_stats():
+    try:
+        stats = read_disk_stats()
+    except OSError:
+        stats = None
+    with disk_cache_lock:
+        if stats is not None:
+            disk_cache["stats"] = stats
+            disk_cache["at"] = time.monotonic()
+        disk_cache["refreshing"] = False
+
+def disk_stats():
+    """
+    Disk total/used/free plus pre-formatted *_h strings, shared across requests.
+
+    The first call reads them; later calls get the cached copy. Once it is older than
+    DISK_STATS_TTL a single background thread refreshes it while callers keep getting
+    the previous figures, so concurrent dashboards never stack up statvfs calls.
+    """
+    if DISK_STATS_TTL <= 0:
+        return read_disk_stats()
+    with disk_cache_lock:
+        stats = disk_cache["stats"]
+        if stats is None:
+            stats = disk_cache["stats"] = read_disk_stats()
+            disk_cache["at"] = time.monotonic()
+        elif time.monotonic() - disk_cache["at"] >= DISK_STATS_TTL and not disk_cache["refreshing"]:
+            disk_cache["refreshing"] = True
+            threading.Thread(target=refresh_disk_stats, name="disk-stats", daemon=True).start()
+        return stats
+
+# ---------------- Usage ledger & file index ----------------
+# Per-user bytes/file counts (usage_ledger) and per-entry metadata (files) kept in
+# SQLite so stats and listings are indexed reads instead of walks. Mutating routes
+# update both in one transaction; reconcile_usage() rescans the disk to fix drift.
+
+scan_pool = ThreadPoolExecutor(max_workers=SCAN_WORKERS, thread_name_prefix="usage-scan")
+
+def rel_parent(rel: str) -> str:
+    return rel.rsplit("/", 1)[0] if "/" in rel else ""
+
+RECONCILE_ATTEMPTS = 3  # rescans before giving up on a tree that keeps changing
+
+def reconcile_usage(user_id: int):
+    """
+    Rescan a user's storage from disk, overwrite their ledger row and rebuild their
+    file index (keeping the recorded mtime and hash of files that haven't changed).
+
+    Returns (bytes, files, complete). A tree that kept changing through
+    RECONCILE_ATTEMPTS scans returns the last figures with complete=False and leaves
+    the ledger and index untouched. Half-written uploads found on the
+    way that are older than UPLOAD_SESSION_TTL (left by a crashed worker) are removed.
+    """
+    rootp = user_root(user_id)
+    os.makedirs(rootp, exist_ok=True)
+    for _ in range(RECONCILE_ATTEMPTS):
+        # an upload/delete/rename committed while the disk is walked would be wiped out
+        # by the rebuild, so the snapshot is only written if the version hasn't moved
+        version = get_version(user_id)
+        entries = []
+        temps = []
+        totals = scan_tree(rootp, entries, temps)
+        remove_stale_temps(temps)
+        used, files = totals["bytes"], totals["files"]
+
+        conn = db()
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("SELECT version FROM tree_versions WHERE user_id=?", (user_id,))
+        row = cur.fetchone()
+        if (int(row["version"]) if row else 0) == version:
+            break
+        conn.rollback()
+        conn.close()
+    else:
+        return used, files, False
+
+    cur.execute("SELECT path, size, mtime, hash FROM files WHERE user_id=? AND hash IS NOT NULL", (user_id,))
+    hashes = {r["path"]: (r["size"], r["mtime"], r["hash"]) for r in cur.fetchall()}
+
+    def indexed(rel, size, mtime):
+        """(mtime, hash) to index: the recorded pair while it still describes the file."""
+        old = hashes.get(rel)
+        if old and old[0] == size and (old[1] == mtime or blob_linked(os.path.join(rootp, rel), old[2])):
+            return old[1], old[2]
+        return mtime, None
+
+    cur.execute("DELETE FROM files WHERE user_id=?", (user_id,))
+    # the rescan may have found anything; delta clients must reload from scratch
+    record_change(cur, user_id, bump_version(cur, user_id), "reset", "")
+    cur.executemany(
+        "INSERT INTO files (user_id, path, parent, name, type, size, mtime, hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [(user_id, rel, rel_parent(rel), rel.rsplit("/", 1)[-1], kind, size, *indexed(rel, size, mtime))
+         for rel, kind, size, mtime in entries]
+    )
+    cur.execute(
+        """INSERT INTO usage_ledger (user_id, bytes, files, reconciled_at) VALUES (?, ?, ?, ?)
+           ON CONFLICT(user_id) DO UPDATE SET bytes=excluded.bytes, files=excluded.files,
+           reconciled_at=excluded.reconciled_at""",
+        (user_id, used, files, int(time.time()))
+    )
+    conn.commit()
+    conn.close()
+    return used, files, True
+
+def remove_stale_temps(paths):
+    cutoff = time.time() - UPLOAD_SESSION_TTL
+    for path in paths:
+        try:
+            if os.stat(path).st_mtime < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+def get_usage(user_id: int):
+    """Return (bytes, files) for a user; seeds the ledger from disk on first use."""
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("SELECT bytes, files FROM usage_ledger WHERE user_id=?", (user_id,))
+    row = cur.fetchone()
+    conn.close()
+    if not row:
+        used, files, _ = reconcile_usage(user_id)
+        return used, files
+    return int(row["bytes"]), int(row["files"])
+
+usage_scans = {}  # user_id -> Future of the latest reconcile_usage() on scan_pool
+usage_scans_lock = threading.Lock()
+
+def submit_usage_scan(user_id: int):
+    """The scan of this user's storage still running on scan_pool, or a new one."""
+    with usage_scans_lock:
+        fut = usage_scans.get(user_id)
+        if fut is None or fut.done():
+            fut = usage_scans[user_id] = scan_pool.submit(reconcile_usage, user_id)
+    return fut
+
+def usage_for_users(user_ids, rescan: bool = False) -> dict:
+    """
+    Usage for many users at once: {user_id: {"bytes", "files", "stale"}}.
+
+    Users without a ledger row (or everyone, with rescan=True) are scanned in parallel
+    on scan_pool, and the results are waited for until one deadline SCAN_TIMEOUT_SECONDS
+    from now. A scan that doesn't finish in time is reported as stale (the last ledger
+    figures, or zeros) and keeps running, writing the ledger when it is done; later
+    calls wait on that scan instead of starting another.
+    """
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("SELECT user_id, bytes, files FROM usage_ledger")
+    ledger = {int(r["user_id"]): (int(r["bytes"]), int(r["files"])) for r in cur.fetchall()}
+    conn.close()
+
+    deadline = time.monotonic() + SCAN_TIMEOUT_SECONDS
+    pending = {uid: submit_usage_scan(uid) for uid in user_ids if rescan or uid not in ledger}
+
+    out = {}
+    for uid in user_ids:
+        used, files = ledger.get(uid, (0, 0))
+        stale = False
+        if uid in pending:
+            try:
+                s_used, s_files, complete = pending[uid].result(timeout=max(0.0, deadline - time.monotonic()))
+            except (FutureTimeout, OSError):
+                stale = True
+            else:
+                if complete or uid not in ledger:
+                    used, files = s_used, s_files
+                stale = not complete
+        out[uid] = {"bytes": used, "files": files, "stale": stale}
+    return out
+
+def bump_version(cur, user_id: int) -> int:
+    """
+    Advance the user's change version; every route that changes their tree calls this
+    and then journals at least one record_change() under the returned version.
+    """
+    cur.execute(
+        "INSERT INTO tree_versions (user_id, version) VALUES (?, 1) "
+        "ON CONFLICT(user_id) DO UPDATE SET version = version + 1",
+        (user_id,)
+    )
+    cur.execute("SELECT version FROM tree_versions WHERE user_id=?", (user_id,))
+    version = int(cur.fetchone()["version"])
+    cur.execute("DELETE FROM tree_changes WHERE user_id=? AND version <= ?", (user_id, version - JOURNAL_KEEP_VERSIONS))
+    return version
+
+def record_change(cur, user_id: int, version: int, op: str, path: str,
+                  new_path: str = None, kind: str = None, size: int = None):
+    """Journal one tree operation: add / remove / rename / resize, or reset after a rescan."""
+    cur.execute(
+        "INSERT INTO tree_changes (user_id, version, op, path, new_path, type, size) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (user_id, version, op, path, new_path, kind, size)
+    )
+
+def changes_since(user_id: int, since: int):
+    """
+    (version, changes) with the journal after `since`, oldest first, or (version, None)
+    when the client has to reload: the journal was pruned past it, a rescan reset it,
+    or `since` is from some other timeline.
+    """
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("SELECT version FROM tree_versions WHERE user_id=?", (user_id,))
+    row = cur.fetchone()
+    current = int(row["version"]) if row else 0
+    if since == current:
+        conn.close()
+        return current, []
+    cur.execute(
+        "SELECT version, op, path, new_path, type, size FROM tree_changes WHERE user_id=? AND version > ? ORDER BY id",
+        (user_id, since)
+    )
+    rows = cur.fetchall()
+    conn.close()
+
+    # every bump journals something, so a complete journal starts right at since + 1
+    if since > current or not rows or int(rows[0]["version"]) != since + 1 or any(r["op"] == "reset" for r in rows):
+        return current, None
+    changes = []
+    for r in rows:
+        ch = {"op": r["op"], "path": r["path"]}
+        for key in ("new_path", "type", "size"):
+            if r[key] is not None:
+                ch[key] = r[key]
+        changes.append(ch)
+    return current, changes
+
+def get_version(user_id: int) -> int:
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("SELECT version FROM tree_versions WHERE user_id=?", (user_id,))
+    row = cur.fetchone()
+    conn.close()
+    return int(row["version"]) if row else 0
+
+def ensure_indexed(user_id: int):
+    """A ledger row means the index was built by the same rescan; build both if missing."""
+    get_usage(user_id)
+
+def adjust_usage(cur, user_id: int, d_bytes: int, d_files: int):
+    """Apply a delta to a user's ledger row; the caller commits with its index writes.
+
+    Users without a row are left alone: their first get_usage() scans the disk anyway.
+    """
+    if not d_bytes and not d_files:
+        return
+    cur.execute(
+        "UPDATE usage_ledger SET bytes = MAX(0, bytes + ?), files = MAX(0, files + ?) WHERE user_id=?",
+        (d_bytes, d_files, user_id)
+    )
+
+def index_put(cur, user_id: int, rel: str, kind: str, size: int = 0, mtime: float = None, file_hash: str = None):
+    cur.execute(
+        "INSERT OR REPLACE INTO files (user_id, path, parent, name, type, size, mtime, hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (user_id, rel, rel_parent(rel), rel.rsplit("/", 1)[-1], kind, size,
+         time.time() if mtime is None else mtime, file_hash)
+    )
+
+def index_ensure_dirs(cur, user_id: int, rel_dir: str) -> list:
+    """Index rel_dir and each of its ancestors as folders; returns the ones that were new."""
+    parts = [p for p in rel_dir.split("/") if p]
+    now = time.time()
+    added = []
+    for i in range(len(parts)):
+        rel = "/".join(parts[:i + 1])
+        cur.execute(
+            "INSERT OR IGNORE INTO files (user_id, path, parent, name, type, size, mtime) VALUES (?, ?, ?, ?, 'folder', 0, ?)",
+            (user_id, rel, rel_parent(rel), parts[i], now)
+        )
+        if cur.rowcount == 1:
+            added.append(rel)
+    return added
+
+# Descendants of "a/b" are exactly the paths in ("a/b/", "a/b0"): "0" sorts right after
+# "/", so this stays a primary-key range scan instead of a LIKE with escaping.
+
+def index_remove(cur, user_id: int, rel: str):
+    cur.execute(
+        "DELETE FROM files WHERE user_id=? AND (path=? OR (path > ? AND path < ?))",
+        (user_id, rel, rel + "/", rel + "0")
+    )
+
+def index_rename(cur, user_id: int, old_rel: str, new_rel: str):
+    cur.execute(
+        "UPDATE OR REPLACE files SET path=?, parent=?, name=? WHERE user_id=? AND path=?",
+        (new_rel, rel_parent(new_rel), new_rel.rsplit("/", 1)[-1], user_id, old_rel)
+    )
+    cut = len(old_rel) + 1
+    cur.execute(
+        """UPDATE OR REPLACE files SET path = ? || substr(path, ?), parent = ? || substr(parent, ?)
+           WHERE user_id=? AND path > ? AND path < ?""",
+        (new_rel, cut, new_rel, cut, user_id, old_rel + "/", old_rel + "0")
+    )
+
+def index_tree(user_id: int, rel: str = "", depth: int = 1):
+    """folder_tree() for depth-limited listings, answered from the file index."""
+    conn = db()
+    cur = conn.cursor()
+
+    def count_children(folder_rel):
+        cur.execute("SELECT COUNT(*) FROM files WHERE user_id=? AND parent=?", (user_id, folder_rel))
+        return int(cur.fetchone()[0])
+
+    def scan_dir(folder_rel, levels):
+        node = {"name": folder_rel.rsplit("/", 1)[-1] if folder_rel else "", "path": folder_rel, "type": "folder"}
+        if levels <= 0:
+            node["count"] = count_children(folder_rel)
+            return node
+        cur.execute("SELECT path, name, type, size FROM files WHERE user_id=? AND parent=?", (user_id, folder_rel))
+        rows = sorted(cur.fetchall(), key=lambda r: r["name"].lower())
+        node["count"] = len(rows)
+        node["children"] = [
+            scan_dir(r["path"], levels - 1) if r["type"] == "folder"
+            else {"name": r["name"], "path": r["path"], "type": "file", "size": r["size"]}
+            for r in rows
+        ]
+        return node
+
+    if rel:
+        cur.execute("SELECT 1 FROM files WHERE user_id=? AND path=? AND type='folder'", (user_id, rel))
+        if not cur.fetchone():
+            conn.close()
+            return {"name": "", "path": rel, "type": "folder", "count": 0, "children": []}
+    out = scan_dir(rel, depth)
+    conn.close()
+    return out
+
+def path_usage(abs_path: str):
+    """(bytes, files) held by a file or folder, measured before it is deleted or replaced."""
+    if os.path.isdir(abs_path):
+        totals = scan_tree(abs_path)
+        return totals["bytes"], totals["files"]
+    try:
+        return os.path.getsize(abs_path), 1
+    except OSError:
+        return 0, 0
+
+def record_writes(cur, user_id: int, written: list):
+    """
+    Ledger, index and journal entries for files just written to disk, as one tree version.
+    `written` holds (rel_path, stat_result, old_bytes, old_files, file_hash, mtime) per
+    file, the old values being what path_usage() measured at that path before it was
+    replaced and mtime the one to index (see apply_client_mtime()).
+    """
+    if not written:
+        return
+    version = bump_version(cur, user_id)
+    adjust_usage(cur, user_id,
+                 sum(st.st_size - old_bytes for _, st, old_bytes, *_ in written),
+                 sum(1 - old_files for _, _, _, old_files, *_ in written))
+    for rel_dir in sorted({rel_parent(rel) for rel, *_ in written}):
+        for d in index_ensure_dirs(cur, user_id, rel_dir):
+            record_change(cur, user_id, version, "add", d, kind="folder")
+    replaced = []  # blobs that lost a link when a file was overwritten
+    for rel, st, _, old_files, file_hash, mtime in written:
+        if old_files and DEDUP_STORAGE:
+            cur.execute("SELECT hash FROM files WHERE user_id=? AND path=?", (user_id, rel))
+            row = cur.fetchone()
+            if row and row["hash"] and row["hash"] != file_hash:
+                replaced.append(row["hash"])
+        index_put(cur, user_id, rel, "file", st.st_size, mtime, file_hash)
+        record_change(cur, user_id, version, "resize" if old_files else "add", rel, kind="file", size=st.st_size)
+    release_blobs(replaced)
+
+def indexed_hashes(cur, user_id: int, rel: str) -> list:
+    """Content hashes recorded for `rel` and everything under it, read before it is removed."""
+    cur.execute(
+        "SELECT DISTINCT hash FROM files WHERE user_id=? AND hash IS NOT NULL AND (path=? OR (path > ? AND path < ?))",
+        (user_id, rel, rel + "/", rel + "0")
+    )
+    return [r["hash"] for r in cur.fetchall()]
+
+def reconcile_all_usage():
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM users")
+    uids = [int(r["id"]) for r in cur.fetchall()]
+    conn.close()
+    # own pool so a long reconcile doesn't queue ahead of interactive admin scans
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS, thread_name_prefix="usage-reconcile") as pool:
+        list(pool.map(reconcile_usage, uids))
+
+def usage_reconcile_loop():
+    while True:
+        time.sleep(USAGE_RECONCILE_SECONDS)
+        try:
+            reconcile_all_usage()
+            expire_upload_sessions()
+            sweep_blobs()
+        except Exception:
+            app.logger.exception("Usage reconcile failed")
+
+usage_reconciler = None
+
+def start_usage_reconciler():
+    """Start the reconcile thread, once per process."""
+    global usage_reconciler
+    if USAGE_RECONCILE_SECONDS <= 0 or usage_reconciler is not None:
+        return
+    usage_reconciler = threading.Thread(target=usage_reconcile_loop, name="usage-reconcile", daemon=True)
+    usage_reconciler.start()
+
+# ---------------- Resumable uploads ----------------
+
+def upload_part_path(session_id: str) -> str:
+    return os.path.join(UPLOADS_DIR, session_id + ".part")
+
+def reserved_upload_bytes(cur) -> int:
+    """
+    Bytes the open resumable uploads may still write: their sizes less what has arrived.
+    Partial files are sparse, so this is the space promised but not yet taken on disk.
+    """
+    cur.execute(
+        """SELECT s.size, s.received, COUNT(p.part) AS parts FROM upload_sessions s
+           LEFT JOIN upload_parts p ON p.session_id = s.id GROUP BY s.id"""
+    )
+    return sum(max(0, r["size"] - max(r["received"], r["parts"] * UPLOAD_PART_BYTES)) for r in cur.fetchall())
+
+def get_upload_session(user_id: int, session_id: str):
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM upload_sessions WHERE id=? AND user_id=?", (session_id, user_id))
+    row = cur.fetchone()
+    conn.close()
+    return row
+
+def upload_part_count(size: int) -> int:
+    return -(-size // UPLOAD_PART_BYTES)
+
+def upload_parts_done(session_id: str) -> list:
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("SELECT part FROM upload_parts WHERE session_id=? ORDER BY part", (session_id,))
+    parts = [r["part"] for r in cur.fetchall()]
+    conn.close()
+    return parts
+
+def upload_session_complete(row) -> bool:
+    """All bytes arrived, either in order through ?offset= or as a full set of parts."""
+    if row["received"] >= row["size"]:
+        return True
+    return len(upload_parts_done(row["id"])) == upload_part_count(row["size"])
+
+def upload_session_state(row) -> dict:
+    return {"ok": True, "id": row["id"], "offset": row["received"], "size": row["size"],
+            "part_size": UPLOAD_PART_BYTES, "parts": upload_parts_done(row["id"])}
+
+def drop_upload_session(session_id: str):
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM upload_sessions WHERE id=?", (session_id,))
+    cur.execute("DELETE FROM upload_parts WHERE session_id=?", (session_id,))
+    conn.commit()
+    conn.close()
+    try:
+        os.remove(upload_part_path(session_id))
+    except FileNotFoundError:
+        pass
+
+def expire_upload_sessions():
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM upload_sessions WHERE updated_at < ?", (int(time.time()) - UPLOAD_SESSION_TTL,))
+    ids = [r["id"] for r in cur.fetchall()]
+    conn.close()
+    for session_id in ids:
+        drop_upload_session(session_id)
+    # uploads staged here before their folder existed
+    with os.scandir(UPLOADS_DIR) as it:
+        remove_stale_temps([e.path for e in it if is_upload_temp(e.name)])
+
+# ---------------- Streaming uploads ----------------
+
+# mkstemp() creates files 0600; uploads get the mode a plain open() would have given them
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+def blob_path(digest: str) -> str:
+    return os.path.join(BLOBS_DIR, digest[:2], digest)
+
+def adopt_blob(path: str, digest: str):
+    """
+    Make `path` a hardlink of the blob for `digest`. The first copy of some content
+    becomes the blob; a later copy is swapped for a link to it, freeing its own bytes.
+    Where hardlinks fail, `path` just stays a plain file.
+    """
+    blob = blob_path(digest)
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    try:
+        os.link(path, blob)
+        return
+    except FileExistsError:
+        pass
+    except OSError:
+        return
+    link_tmp = path + ".link"
+    try:
+        os.link(blob, link_tmp)
+        os.replace(link_tmp, path)
+    except OSError:
+        try:
+            os.remove(link_tmp)
+        except FileNotFoundError:
+            pass
+
+def blob_linked(path: str, digest: str, st=None) -> bool:
+    """
+    Whether `path` is (still) a hardlink of the blob for `digest`, so holds exactly that
+    content. Its mtime then belongs to the shared inode, not to this path.
+    """
+    if not (DEDUP_STORAGE and digest):
+        return False
+    try:
+        st = st or os.stat(path)
+        blob = os.stat(blob_path(digest))
+    except OSError:
+        return False
+    return (st.st_dev, st.st_ino) == (blob.st_dev, blob.st_ino)
+
+def release_blobs(digests):
+    """Drop the blobs among `digests` that no user path links to any more."""
+    for digest in set(digests):
+        try:
+            if os.stat(blob_path(digest)).st_nlink <= 1:
+                os.remove(blob_path(digest))
+        except FileNotFoundError:
+            pass
+
+def sweep_blobs():
+    """release_blobs() for every blob, catching links removed outside the app."""
+    if not os.path.isdir(BLOBS_DIR):
+        return
+    for shard in os.scandir(BLOBS_DIR):
+        if shard.is_dir(follow_symlinks=False):
+            release_blobs(e.name for e in os.scandir(shard.path))
+
+class StagedWrite:
+    """
+    An uploaded file written under a temp name in `dir_path` and renamed over its
+    final name on commit(), so its bytes hit the disk once and nobody sees half a file.
+    The data is hashed (SHA-256) on the way through, so checking it against the client's
+    digest and indexing it need no second read; `hash` is set on commit. In dedup mode
+    the file is committed as a blob link.
+    """
+
+    def __init__(self, dir_path: str):
+        fd, self.tmp_path = tempfile.mkstemp(prefix=UPLOAD_TEMP_PREFIX, suffix=".part", dir=dir_path)
+        self.f = os.fdopen(fd, "wb")
+        self.hasher = hashlib.sha256()
+        self.hash = None
+
+    def write(self, data):
+        self.f.write(data)
+        self.hasher.update(data)
+
+    def matches(self, digest) -> bool:
+        """False if the client sent a hex SHA-256 `digest` and the data received differs from it."""
+        return not digest or str(digest).strip().lower() == self.hasher.hexdigest()
+
+    def commit(self, target_path: str):
+        self.f.close()
+        os.chmod(self.tmp_path, 0o666 & ~UMASK)
+        self.hash = self.hasher.hexdigest()
+        if DEDUP_STORAGE:
+            adopt_blob(self.tmp_path, self.hash)
+        os.replace(self.tmp_path, target_path)
+        self.tmp_path = None
+
+    def discard(self):
+        self.f.close()
+        if self.tmp_path:
+            try:
+                os.remove(self.tmp_path)
+            except FileNotFoundError:
+                pass
+            self.tmp_path = None
+
+upload_slots = threading.BoundedSemaphore(UPLOAD_SLOTS)
+
+def upload_slot(view):
+    """Run at most UPLOAD_SLOTS of the wrapped uploads at once; turn the rest away with 429."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not upload_slots.acquire(blocking=False):
+            resp = jsonify({"ok": False, "msg": "Server busy, try again shortly."})
+            resp.status_code = 429
+            resp.headers["Retry-After"] = str(UPLOAD_RETRY_AFTER)
+            return resp
+        try:
+            return view(*args, **kwargs)
+        finally:
+            upload_slots.release()
+    return wrapper
+
+# Folders already resolved and created, per (user, folder upload), so a chunk of
+# hundreds of files in a few folders does a few safe_join/makedirs calls, not hundreds.
+# Dropped for a user on delete/rename; an entry gone stale anyway only costs a retry.
+upload_dirs = {}  # (user_id, upload_id) -> (last_used, {rel_dir: abs_dir, or None if not created yet})
+upload_dirs_lock = threading.Lock()
+
+def upload_dir_cache(user_id: int, upload_id: str) -> dict:
+    """The {rel_dir: abs_dir} cache shared by the requests of one folder upload."""
+    if not upload_id:
+        return {}
+    now = time.time()
+    with upload_dirs_lock:
+        for key in [k for k, (used, _) in upload_dirs.items() if now - used > UPLOAD_SESSION_TTL]:
+            del upload_dirs[key]
+        _, dirs = upload_dirs.get((user_id, upload_id), (now, {}))
+        upload_dirs[(user_id, upload_id)] = (now, dirs)
+    return dirs
+
+def forget_upload_dirs(user_id: int):
+    with upload_dirs_lock:
+        for key in [k for k in upload_dirs if k[0] == user_id]:
+            del upload_dirs[key]
+
+def staged_write_in(root: str, rel_dir: str, dirs: dict) -> StagedWrite:
+    """Stage next to the destination when that folder exists; otherwise under UPLOADS_DIR,
+    so a rejected upload leaves no new folders behind."""
+    if rel_dir in dirs:
+        dir_path = dirs[rel_dir]
+    else:
+        dir_path = safe_join(root, rel_dir)
+        if not os.path.isdir(dir_path):
+            dir_path = None  # not created yet; place_upload() fills this in
+        dirs[rel_dir] = dir_path
+    if dir_path is None:
+        return StagedWrite(UPLOADS_DIR)
+    try:
+        return StagedWrite(dir_path)
+    except FileNotFoundError:
+        dirs.pop(rel_dir, None)
+        return StagedWrite(UPLOADS_DIR)
+
+def place_upload(staged: StagedWrite, root: str, rel_dir: str, rel_name: str, dirs: dict):
+    """
+    Commit `staged` as rel_dir/rel_name under `root`, creating rel_dir once per `dirs`.
+    Returns (target_path, old_bytes, old_files) for record_writes().
+    """
+    target_dir = dirs.get(rel_dir)
+    if target_dir is None:
+        target_dir = safe_join(root, rel_dir)
+        os.makedirs(target_dir, exist_ok=True)
+        dirs[rel_dir] = target_dir
+    target_path = os.path.join(target_dir, rel_name)
+    old_bytes, old_files = path_usage(target_path) if os.path.isfile(target_path) else (0, 0)
+    try:
+        staged.commit(target_path)
+    except FileNotFoundError:
+        # the cached folder was removed meanwhile, e.g. by another worker
+        os.makedirs(target_dir, exist_ok=True)
+        staged.commit(target_path)
+    return target_path, old_bytes, old_files
+
+def apply_client_mtime(path: str, mtime):
+    """
+    (stat_result, mtime to index) for an uploaded file, keeping the client's `mtime` so a
+    later manifest check sees the file as unchanged. It goes on the inode only while the
+    file has a single link: a dedup blob's inode is shared with other paths, possibly
+    other users', and is never touched, so there the client's mtime lives in the index alone.
+    """
+    st = os.stat(path)
+    try:
+        mtime = float(mtime)
+    except (TypeError, ValueError):
+        return st, st.st_mtime
+    if not math.isfinite(mtime):
+        return st, st.st_mtime
+    if st.st_nlink > 1:
+        return st, mtime
+    try:
+        os.utime(path, (mtime, mtime))
+    except (OverflowError, OSError):
+        return st, st.st_mtime
+    st = os.stat(path)
+    return st, st.st_mtime
+
+def read_multipart(open_file):
+    """
+    Parse the multipart/form-data request body as it streams in, instead of letting
+    werkzeug spool each file part to a temp file that save() then copies again.
+
+    Text fields are collected as {name: [values]}. For every file part,
+    open_file(name, filename, fields) is called with the fields seen so far and
+    returns a StagedWrite to receive its data, or None to drop it.
+    Returns (fields, files), files being [(name, filename, staged or None)] in
+    body order. If anything fails, every StagedWrite is discarded.
+    """
+    boundary = request.mimetype_params.get("boundary", "").encode("latin-1")
+    if request.mimetype != "multipart/form-data" or not boundary:
+        return {}, []
+
+    max_memory = request.max_form_memory_size
+    decoder = MultipartDecoder(boundary, max_memory, max_parts=request.max_form_parts)
+    stream = request.stream
+    fields, files = {}, []
+    field_name, sink = None, None  # sink: StagedWrite, bytearray for a text field, or None
+    field_bytes = 0
+    try:
+        while True:
+            chunk = stream.read(UPLOAD_WRITE_BYTES)
+            decoder.receive_data(chunk or None)
+            event = decoder.next_event()
+            while not isinstance(event, NeedData):
+                if isinstance(event, Epilogue):
+                    return fields, files
+                if isinstance(event, File):
+                    sink = open_file(event.name, event.filename, fields)
+                    files.append((event.name, event.filename, sink))
+                elif isinstance(event, Field):
+                    field_name, sink = event.name, bytearray()
+                elif isinstance(event, Data):
+                    if isinstance(sink, bytearray):
+                        field_bytes += len(event.data)
+                        if max_memory is not None and field_bytes > max_memory:
+                            raise RequestEntityTooLarge()
+                        sink += event.data
+                        if not event.more_data:
+                            fields.setdefault(field_name, []).append(sink.decode("utf-8", "replace"))
+                    elif sink is not None:
+                        sink.write(event.data)
+                event = decoder.next_event()
+            if not chunk:
+                raise ClientDisconnected()
+    except Exception:
+        for *_, staged in files:
+            if staged is not None:
+                staged.discard()
+        raise
+
+# ---------------- Conditional GET ----------------
+
+def conditional_response(etag: str, build):
+    """
+    304 if the client's If-None-Match already has `etag`, otherwise make_response(build()).
+
+    ETags are weak (they name a state, e.g. a tree version, not exact bytes) and the
+    response is private/no-cache so every use revalidates against the current version.
+    """
+    if request.if_none_match.contains_weak(etag):
+        resp = app.response_class(status=304)
+    else:
+        resp = make_response(build())
+    resp.set_etag(etag, weak=True)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+# ---------------- Downloads ----------------
+
+class FileRange:
+    """
+    File-like view of bytes [start, stop) of an open file. fileno() is passed through, so
+    a server's wsgi.file_wrapper (gunicorn) can sendfile() the range straight from the
+    current offset, bounded by Content-Length; anything else reads only the range.
+    """
+
+    def __init__(self, f, start: int, stop: int):
+        f.seek(start)
+        self.f = f
+        self.left = stop - start
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def read(self, n: int = -1) -> bytes:
+        if n < 0 or n > self.left:
+            n = self.left
+        data = self.f.read(n)
+        self.left -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+def file_etag(st, file_hash: str = None) -> str:
+    """
+    Strong validator for a file's current bytes: its SHA-256 when known, so it survives
+    a touch or a copy, otherwise one that changes with its inode, size or mtime.
+    """
+    if file_hash:
+        return "sha256-" + file_hash
+    return f"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"
+
+def indexed_file(user_id: int, rel: str, path: str, st):
+    """
+    (hash, mtime) recorded for `rel` while its index entry still describes the file on
+    disk, else (None, the file's own mtime). A dedup link's inode mtime is shared with
+    other paths, so the recorded one is what its owner sees.
+    """
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("SELECT size, mtime, hash FROM files WHERE user_id=? AND path=? AND type='file'", (user_id, rel))
+    row = cur.fetchone()
+    conn.close()
+    if row and row["hash"] and row["size"] == st.st_size and (row["mtime"] == st.st_mtime or blob_linked(path, row["hash"], st)):
+        return row["hash"], row["mtime"]
+    return None, st.st_mtime
+
+def requested_ranges(size: int, etag: str, mtime: float):
+    """
+    The byte ranges asked for in the Range header as [(start, stop)], or None to send the
+    whole file: no or malformed Range, an If-Range the file no longer matches, or more
+    than DOWNLOAD_MAX_RANGES ranges. An empty list means none of them can be satisfied.
+    """
+    rng = request.range
+    if rng is None or rng.units != "bytes" or len(rng.ranges) > DOWNLOAD_MAX_RANGES or not size:
+        return None
+    if "If-Range" in request.headers:
+        if_range = request.if_range
+        if if_range.date is not None:
+            if int(if_range.date.timestamp()) != int(mtime):
+                return None
+        elif if_range.etag != etag or request.headers["If-Range"].startswith("W/"):
+            return None  # If-Range needs a strong match
+    ranges = []
+    for start, stop in rng.ranges:
+        if start < 0:
+            start, stop = max(0, size + start), size  # suffix range: the last -start bytes
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+def attachment_params(name: str) -> dict:
+    """Content-Disposition parameters for `name`, with an RFC 5987 filename* when it isn't ASCII."""
+    try:
+        name.encode("ascii")
+        return {"filename": name}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode("ascii")
+        return {"filename": simple, "filename*": "UTF-8''" + quote(name, safe="!#$&+-.^_`|~")}
+
+def multipart_ranges(path: str, ranges: list, size: int, mimetype: str, boundary: str):
+    """(content_length, body iterator) of a multipart/byteranges response."""
+    heads = [(f"--{boundary}\r\nContent-Type: {mimetype}\r\n"
+              f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n").encode("latin-1")
+             for start, stop in ranges]
+    tail = f"--{boundary}--\r\n".encode("latin-1")
+    length = sum(len(h) + stop - start + 2 for h, (start, stop) in zip(heads, ranges)) + len(tail)
+
+    def body():
+        with open(path, "rb") as f:
+            for head, (start, stop) in zip(heads, ranges):
+                yield head
+                f.seek(start)
+                while start < stop:
+                    data = f.read(min(DOWNLOAD_READ_BYTES, stop - start))
+                    if not data:
+                        return  # file shrank underneath us; the short body tells the client
+                    start += len(data)
+                    yield data
+                yield b"\r\n"
+            yield tail
+
+    return length, body()
+
+def send_user_file(path: str, st=None, file_hash: str = None, mtime: float = None):
+    """
+    Send a user's file as an attachment, honouring Range (one range, or several as
+    multipart/byteranges), If-Range and conditional GET. The whole file and single
+    ranges go out through wsgi.file_wrapper, so servers with sendfile support use it.
+
+    If-None-Match / If-Modified-Since matching the file's validators get a bodiless 304,
+    so re-fetching an unchanged file costs a stat. Responses are private (never kept by
+    shared caches) and no-cache (browsers revalidate before reusing them).
+    `mtime` overrides the file's own for Last-Modified (see indexed_file()).
+    """
+    st = st or os.stat(path)
+    mtime = st.st_mtime if mtime is None else mtime
+    name = os.path.basename(path)
+    mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    etag = file_etag(st, file_hash)
+    modified = datetime.fromtimestamp(int(mtime), timezone.utc)
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=modified):
+        resp = app.response_class(status=304)
+    else:
+        ranges = requested_ranges(st.st_size, etag, mtime)
+        if ranges == []:
+            resp = app.response_class(status=416)
+            resp.headers["Content-Range"] = f"bytes */{st.st_size}"
+        elif ranges is None:
+            resp = app.response_class(wrap_file(request.environ, open(path, "rb"), DOWNLOAD_READ_BYTES),
+                                      mimetype=mimetype, direct_passthrough=True)
+            resp.content_length = st.st_size
+        elif len(ranges) == 1:
+            start, stop = ranges[0]
+            part = FileRange(open(path, "rb"), start, stop)
+            resp = app.response_class(wrap_file(request.environ, part, DOWNLOAD_READ_BYTES),
+                                      status=206, mimetype=mimetype, direct_passthrough=True)
+            resp.content_length = stop - start
+            resp.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{st.st_size}"
+        else:
+            boundary = secrets.token_hex(16)
+            length, body = multipart_ranges(path, ranges, st.st_size, mimetype, boundary)
+            resp = app.response_class(body, status=206, direct_passthrough=True)
+            resp.headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+            resp.content_length = length
+        resp.headers.set("Content-Disposition", "attachment", **attachment_params(name))
+
+    resp.headers["Accept-Ranges"] = "bytes"
+    resp.set_etag(etag)
+    resp.last_modified = modified
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+def offload_response(path: str):
+    """
+    Empty response telling the reverse proxy to send `path` (see DOWNLOAD_OFFLOAD).
+    Ranges and validators are then handled by the proxy.
+    """
+    name = os.path.basename(path)
+    resp = app.response_class(mimetype=mimetypes.guess_type(name)[0] or "application/octet-stream")
+    if DOWNLOAD_OFFLOAD == "nginx":
+        rel = os.path.relpath(path, STORAGE_DIR).replace(os.sep, "/")
+        resp.headers["X-Accel-Redirect"] = DOWNLOAD_ACCEL_PREFIX + quote(rel)
+    else:
+        resp.headers["X-Sendfile"] = quote(path)
+    resp.headers.set("Content-Disposition", "attachment", **attachment_params(name))
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+class ZipSink:
+    """Write-only, unseekable target for zipfile, so the archive is emitted as it is built."""
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def write(self, data) -> int:
+        self.buf += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = bytes(self.buf)
+        self.buf.clear()
+        return data
+
+def walk_files(abs_path: str, arc_path: str):
+    """
+    (abs_path, arcname, is_dir) for everything under a folder, parents first. Symlinks
+    are skipped (they could point outside the user's storage) and so are half-written uploads.
+    """
+    try:
+        entries = sorted(os.scandir(abs_path), key=lambda e: e.name)
+    except OSError:
+        return
+    if not entries:
+        yield abs_path, arc_path + "/", True  # keep empty folders
+    for e in entries:
+        if e.is_symlink() or is_upload_temp(e.name):
+            continue
+        arcname = f"{arc_path}/{e.name}".lstrip("/")
+        if e.is_dir():
+            yield from walk_files(e.path, arcname)
+        elif e.is_file():
+            yield e.path, arcname, False
+
+def stream_zip(entries, compression: int = zipfile.ZIP_STORED):
+    """
+    Yield a ZIP archive of `entries` ((abs_path, arcname, is_dir), as from walk_files)
+    while it is written: zipfile on an unseekable sink uses data descriptors, and ZIP64
+    records where a file or the archive passes 4GB. Memory stays at about one read block.
+    A file that can't be read any more is left out.
+    """
+    sink = ZipSink()
+    with zipfile.ZipFile(sink, "w", compression=compression, allowZip64=True) as zf:
+        for abs_path, arcname, is_dir in entries:
+            try:
+                info = zipfile.ZipInfo.from_file(abs_path, arcname, strict_timestamps=False)
+                if is_dir:
+                    zf.writestr(info, b"")
+                    continue
+                info.compress_type = compression
+                with open(abs_path, "rb") as src, zf.open(info, "w") as dst:
+                    for block in iter(lambda: src.read(DOWNLOAD_READ_BYTES), b""):
+                        dst.write(block)
+                        if len(sink.buf) >= DOWNLOAD_READ_BYTES:
+                            yield sink.take()
+            except OSError:
+                continue
+            yield sink.take()
+    yield sink.take()  # central directory
+
+def send_zip(entries, name: str):
+    """Streamed attachment response for stream_zip(entries); deflate=1 (query or form) compresses it."""
+    compression = zipfile.ZIP_DEFLATED if request.values.get("deflate") == "1" else zipfile.ZIP_STORED
+    resp = app.response_class(stream_zip(entries, compression), mimetype="application/zip", direct_passthrough=True)
+    resp.headers.set("Content-Disposition", "attachment", **attachment_params(name))
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
 
 # ---------------- Errors ----------------
 
@@ -467,6 +1746,9 @@ APP_HTML = """
   .node-wrapper{
     display:flex;align-items:center;gap:8px;
   }
+  .select-box{
+    width:14px;height:14px;margin:0;padding:0;flex-shrink:0;cursor:pointer;accent-color:var(--accent);
+  }
   .action-btn{
     width:20px;height:20px;border-radius:6px;border:none;
     background:rgba(255,255,255,.10);color:var(--text);
@@ -555,7 +1837,11 @@ APP_HTML = """
     <div id="panelFiles" class="panel grid two">
       <div class="card stack">
         <h2>Browser</h2>
-        <div class="muted">Click a file to download. Folder upload keeps subfolders. (Best in Chrome/Edge/Brave)</div>
+        <div class="muted">Click a file to download, or ⬇ to download a folder as ZIP. Tick several to download them together. Folder upload keeps subfolders. (Best in Chrome/Edge/Brave)</div>
+        <div class="split" id="selectionBar" style="display:none;margin-top:8px;grid-template-columns:1fr auto">
+          <button class="btn" onclick="downloadSelected()">⬇ Download selected (<span id="selectionCount">0</span>)</button>
+          <button class="btn ghost" onclick="clearSelection()">Clear</button>
+        </div>
         <div id="fileTree" class="tree" style="margin-top:10px"></div>
       </div>
 
@@ -579,10 +1865,13 @@ APP_HTML = """
           </div>
           <div>
             <div class="muted">📁 Upload entire folder</div>
-            <input id="uploadDir" type="file" webkitdirectory directory multiple style="margin-top:8px" onchange="calculateOptimalChunkSize()"/>
+            <input id="uploadDir" type="file" webkitdirectory directory multiple style="margin-top:8px" onchange="describeFolderPick()"/>
             <div class="split" style="grid-template-columns: 1fr 1fr; margin-top:8px">
               <div>
-                <input id="chunkSize" type="number" min="10" max="500" value="120" title="Files per chunk" style="font-size:12px"/>
+                <div style="display:flex;gap:6px">
+                  <input id="chunkSize" type="number" min="10" max="450" value="200" title="Max files per chunk" style="font-size:12px"/>
+                  <input id="chunkParallel" type="number" min="1" max="8" value="3" title="Chunks uploading at once" style="font-size:12px;width:56px"/>
+                </div>
                 <div class="mini" id="chunkSuggestion" style="margin-top:4px;font-size:11px;opacity:.8"></div>
               </div>
               <button class="btn" onclick="uploadFolderChunked()">Upload Folder</button>
@@ -715,10 +2004,24 @@ APP_HTML = """
   <div class="toast" id="toast"></div>
 
 <script>
-  function apiFetch(url, opts){
+  // Last ETag + body per GET url, so unchanged trees/stats come back as an empty 304
+  const etagCache = new Map();
+
+  async function apiFetch(url, opts){
     opts = opts || {};
     opts.credentials = "include";
-    return fetch(url, opts);
+    if((opts.method || "GET").toUpperCase() !== "GET") return fetch(url, opts);
+
+    const cached = etagCache.get(url);
+    opts.cache = "no-store"; // we revalidate ourselves; keep the browser cache out of it
+    if(cached) opts.headers = Object.assign({}, opts.headers, {"If-None-Match": cached.etag});
+    const r = await fetch(url, opts);
+    if(r.status === 304 && cached){
+      return new Response(cached.body, {status: 200, headers: {"Content-Type": "application/json", "ETag": cached.etag}});
+    }
+    const etag = r.headers.get("ETag");
+    if(r.ok && etag) etagCache.set(url, {etag, body: await r.clone().text()});
+    return r;
   }
 
   function escapeHtml(s){
@@ -890,7 +2193,7 @@ APP_HTML = """
     users.forEach(u=>{
       html += `<div class="node">
         <div><b>${escapeHtml(u.username)}</b> ${u.is_admin ? "• ADMIN" : ""}</div>
-        <div class="badge">Used: ${u.used_h} • Files: ${u.files}</div>
+        <div class="badge">Used: ${u.used_h} • Files: ${u.files}${u.stale ? " • stale (scan still running)" : ""}</div>
       </div>`;
     });
     html += `</div>`;
@@ -915,16 +2218,244 @@ APP_HTML = """
     // Update the set
     expandedFolders = currentlyExpanded;
     
-    const r = await apiFetch("/api/file_tree");
-    if(r.status===401){ location.href="/login"; return; }
-    const tree = await r.json();
+    // With a model loaded, replay only the server's change journal since its version
+    if(treeModel && treeVersion !== null && await syncTreeChanges()){
+      await loadExpandedLevels();
+      renderModel();
+      return;
+    }
+
+    // Full load: the root level plus each expanded folder, parents first so every
+    // level has a node to hang off. Collapsed folders stay unloaded until opened.
+    const paths = [...expandedFolders].sort(byDepth);
+    const [root, ...levels] = await Promise.all([fetchTreeLevel(""), ...paths.map(fetchTreeLevel)]);
+    if(!root) return;
+    treeModel = root;
+    // Levels can be a version apart; start from the oldest, replaying ops is idempotent
+    treeVersion = Math.min(root.version, ...levels.filter(Boolean).map(l => l.version));
+    paths.forEach((path, i) => {
+      if(!levels[i] || !attachLevel(path, levels[i])) expandedFolders.delete(path);
+    });
+    renderModel();
+  }
+
+  function byDepth(a, b){ return a.split('/').length - b.split('/').length; }
+
+  function parentOf(path){ return path.includes('/') ? path.substring(0, path.lastIndexOf('/')) : ''; }
+
+  async function syncTreeChanges(){
+    const r = await apiFetch("/api/file_tree/changes?since=" + treeVersion);
+    if(r.status===401){ location.href="/login"; return false; }
+    if(!r.ok) return false;
+    const data = await r.json();
+    if(data.reset) return false;
+    data.changes.forEach(applyTreeChange);
+    treeVersion = data.version;
+    return true;
+  }
+
+  async function loadExpandedLevels(){
+    // Folders expanded since the last load (e.g. an upload target) still need their level
+    for(const path of [...expandedFolders].sort(byDepth)){
+      const node = findNode(path);
+      if(node && Array.isArray(node.children)) continue;
+      const level = node ? await fetchTreeLevel(path) : null;
+      if(!level || !attachLevel(path, level)) expandedFolders.delete(path);
+    }
+  }
+
+  function sortChildren(node){
+    node.children.sort((a, b) => {
+      const x = a.name.toLowerCase(), y = b.name.toLowerCase();
+      return x < y ? -1 : (x > y ? 1 : 0);
+    });
+  }
+
+  function retargetNode(node, oldPath, newPath){
+    node.path = newPath + node.path.substring(oldPath.length);
+    (node.children || []).forEach(ch => retargetNode(ch, oldPath, newPath));
+  }
+
+  function forgetExpanded(path){
+    [...expandedFolders].forEach(p => { if(p === path || p.startsWith(path + '/')) expandedFolders.delete(p); });
+  }
+
+  function applyTreeChange(ch){
+    // Only loaded levels hold nodes; for unloaded folders just keep the entry count right
+    const parent = findNode(parentOf(ch.path));
+    const loaded = !!parent && Array.isArray(parent.children);
+    const idx = loaded ? parent.children.findIndex(n => n.path === ch.path) : -1;
+    const name = p => p.substring(p.lastIndexOf('/') + 1);
+
+    if(ch.op === "add"){
+      if(!parent) return;
+      if(!loaded){ parent.count = (parent.count || 0) + 1; return; }
+      if(idx >= 0){
+        if(ch.type === "file") parent.children[idx].size = ch.size || 0;
+        return;
+      }
+      parent.children.push(ch.type === "folder"
+        ? {name: name(ch.path), path: ch.path, type: "folder", count: 0, children: []}
+        : {name: name(ch.path), path: ch.path, type: "file", size: ch.size || 0});
+      sortChildren(parent);
+      parent.count = parent.children.length;
+    }else if(ch.op === "remove"){
+      forgetExpanded(ch.path);
+      forgetSelected(ch.path);
+      if(!parent) return;
+      if(!loaded){ parent.count = Math.max(0, (parent.count || 0) - 1); return; }
+      if(idx >= 0) parent.children.splice(idx, 1);
+      parent.count = parent.children.length;
+    }else if(ch.op === "rename"){
+      [...expandedFolders].forEach(p => {
+        if(p === ch.path || p.startsWith(ch.path + '/')){
+          expandedFolders.delete(p);
+          expandedFolders.add(ch.new_path + p.substring(ch.path.length));
+        }
+      });
+      [...selectedPaths].forEach(p => {
+        if(p === ch.path || p.startsWith(ch.path + '/')){
+          selectedPaths.delete(p);
+          selectedPaths.add(ch.new_path + p.substring(ch.path.length));
+        }
+      });
+      if(idx < 0) return;
+      const node = parent.children[idx];
+      retargetNode(node, ch.path, ch.new_path);
+      node.name = name(ch.new_path);
+      sortChildren(parent);
+    }else if(ch.op === "resize"){
+      if(idx >= 0) parent.children[idx].size = ch.size || 0;
+    }
+  }
+
+  async function fetchTreeLevel(path){
+    const r = await apiFetch("/api/file_tree?depth=1&format=compact&path=" + encodeURIComponent(path));
+    if(r.status===401){ location.href="/login"; return null; }
+    if(!r.ok) return null;
+    return decodeCompactTree(await r.json());
+  }
+
+  // Rebuild nested nodes from the server's parallel arrays (see compact_tree in app.py)
+  const TREE_FOLDER = 1, TREE_LOADED = 2;
+
+  function decodeCompactTree(data){
+    const nodes = [];
+    for(let i = 0; i < data.name.length; i++){
+      const p = data.parent[i];
+      const parent = p < 0 ? null : nodes[p];
+      const name = data.name[i];
+      const path = parent ? (parent.path ? parent.path + '/' + name : name) : data.root;
+      const flags = data.flags[i];
+      const node = (flags & TREE_FOLDER)
+        ? {name, path, type: "folder", count: data.size[i]}
+        : {name, path, type: "file", size: data.size[i]};
+      if((flags & TREE_FOLDER) && (flags & TREE_LOADED)) node.children = [];
+      if(parent) parent.children.push(node);
+      nodes.push(node);
+    }
+    const root = nodes[0];
+    if(root) root.version = data.version;
+    return root;
+  }
+
+  function findNode(path){
+    if(!treeModel) return null;
+    if(!path) return treeModel;
+    let node = treeModel;
+    let prefix = '';
+    for(const part of path.split('/')){
+      prefix = prefix ? prefix + '/' + part : part;
+      node = (node.children || []).find(ch => ch.type==="folder" && ch.path===prefix);
+      if(!node) return null;
+    }
+    return node;
+  }
+
+  function attachLevel(path, level){
+    const node = findNode(path);
+    if(!node) return false;
+    node.children = level.children || [];
+    node.count = level.count;
+    return true;
+  }
+
+  function renderModel(){
     folderCounter = 0;
-    document.getElementById("fileTree").innerHTML = renderTree(tree);
+    document.getElementById("fileTree").innerHTML = renderTree(treeModel);
   }
 
   let folderCounter = 0;
   let renamingPath = null;
   let expandedFolders = new Set();
+  let selectedPaths = new Set();
+  let treeModel = null;
+  let treeVersion = null;
+
+  function selectBox(path){
+    const pathEscaped = path.replace(/'/g, "\\'");
+    return `<input type="checkbox" class="select-box" title="Select" ${selectedPaths.has(path) ? "checked" : ""}
+      onclick="event.stopPropagation()" onchange="toggleSelected('${pathEscaped}', this.checked)"/>`;
+  }
+
+  function toggleSelected(path, on){
+    if(on) selectedPaths.add(path); else selectedPaths.delete(path);
+    updateSelectionBar();
+  }
+
+  function forgetSelected(path){
+    [...selectedPaths].forEach(p => { if(p === path || p.startsWith(path + '/')) selectedPaths.delete(p); });
+    updateSelectionBar();
+  }
+
+  function updateSelectionBar(){
+    document.getElementById("selectionBar").style.display = selectedPaths.size ? "" : "none";
+    document.getElementById("selectionCount").textContent = selectedPaths.size;
+  }
+
+  function clearSelection(){
+    selectedPaths.clear();
+    updateSelectionBar();
+    renderModel();
+  }
+
+  // Target of the batch download form. A ZIP is an attachment and goes to the browser's
+  // downloads without loading the frame; an error reply loads in it instead of over the app.
+  function batchDownloadFrame(){
+    let frame = document.getElementById("batchDownloadFrame");
+    if(frame) return frame;
+    frame = document.createElement("iframe");
+    frame.id = frame.name = "batchDownloadFrame";
+    frame.style.display = "none";
+    frame.addEventListener("load", () => {
+      let doc = null;
+      try{ doc = frame.contentDocument; }catch(e){}
+      if(!doc || !doc.body || doc.location.href === "about:blank") return;
+      // anywhere else than /download_batch is the login page we were redirected to
+      const msg = doc.location.pathname === "/download_batch" ? doc.body.textContent.trim() : "not logged in";
+      toast("Download failed: " + (msg || "server error"), false);
+    });
+    document.body.appendChild(frame);
+    return frame;
+  }
+
+  function downloadSelected(){
+    if(!selectedPaths.size) return;
+    // a real form POST, so the browser streams the archive to disk rather than into a Blob
+    const form = document.createElement("form");
+    form.method = "POST";
+    form.action = "/download_batch";
+    form.target = batchDownloadFrame().name;
+    form.style.display = "none";
+    const input = document.createElement("input");
+    input.type = "hidden";
+    input.name = "paths";
+    input.value = JSON.stringify([...selectedPaths]);
+    form.appendChild(input);
+    document.body.appendChild(form);
+    form.submit();
+    form.remove();
+  }
 
   function renderTree(node, depth=0){
     if(!node) return "";
@@ -941,14 +2472,16 @@ APP_HTML = """
     if(node.type==="folder"){
       const label = node.name;
       const folderId = "f" + (folderCounter++);
-      const hasChildren = node.children && node.children.length > 0;
+      const loaded = Array.isArray(node.children);
+      const hasChildren = loaded ? node.children.length > 0 : node.count > 0;
       const path = node.path || "";
-      const isExpanded = expandedFolders.has(path);
+      const isExpanded = loaded && expandedFolders.has(path);
       const collapsedClass = (hasChildren && !isExpanded) ? "collapsed" : "";
       const pathEscaped = path.replace(/'/g, "\\'");
       
       html += `<div class="node">
         <div class="node-wrapper">
+          ${selectBox(path)}
           <div class="folder-header" onclick="event.stopPropagation(); toggleFolder('${folderId}', '${pathEscaped}')" style="flex:1;cursor:pointer">
             <span class="folder-toggle ${collapsedClass}" id="toggle_${folderId}">▼</span>
             <span class="badge">📁</span>
@@ -962,6 +2495,7 @@ APP_HTML = """
             <span class="badge">${escapeHtml(path)}</span>
           </div>
           <div class="node-actions">
+            <button class="action-btn" onclick="event.stopPropagation(); location.href='/download_folder?p=${encodeURIComponent(path)}'" title="Download as ZIP">⬇</button>
             <button class="action-btn rename" onclick="event.stopPropagation(); startRename('${pathEscaped}')" title="Rename">✏️</button>
             <button class="action-btn delete" onclick="event.stopPropagation(); quickDelete('${pathEscaped}')" title="Delete">✕</button>
           </div>
@@ -969,7 +2503,7 @@ APP_HTML = """
       
       if(hasChildren){
         html += `<div class="folder-children ${collapsedClass}" id="${folderId}">`;
-        node.children.forEach(ch=>{ html += renderTree(ch, depth+1); });
+        (node.children || []).forEach(ch=>{ html += renderTree(ch, depth+1); });
         html += `</div>`;
       }
       html += `</div>`;
@@ -979,6 +2513,7 @@ APP_HTML = """
       const pathEscaped = path.replace(/'/g, "\\'");
       html += `<div class="node">
         <div class="node-wrapper">
+          ${selectBox(path)}
           <div class="node-content click" onclick="location.href='${dl}'" style="flex:1">
             <span class="badge">📄</span>
             ${renamingPath === path ? 
@@ -1000,20 +2535,30 @@ APP_HTML = """
     return html;
   }
 
-  function toggleFolder(folderId, path){
+  async function toggleFolder(folderId, path){
     const children = document.getElementById(folderId);
     const toggle = document.getElementById("toggle_" + folderId);
     if(!children || !toggle) return;
     
     const isCollapsed = children.classList.contains("collapsed");
     if(isCollapsed){
+      // First expansion fetches just this folder's level
+      const node = findNode(path);
+      if(node && !Array.isArray(node.children)){
+        const level = await fetchTreeLevel(path);
+        if(!level || !attachLevel(path, level)){ toast("Could not load folder.", false); return; }
+        if(path) expandedFolders.add(path);
+        renderModel();
+        return;
+      }
       children.classList.remove("collapsed");
       toggle.classList.remove("collapsed");
       if(path) expandedFolders.add(path);
     }else{
       children.classList.add("collapsed");
       toggle.classList.add("collapsed");
-      if(path) expandedFolders.delete(path);
+      // Descendants are dropped too, so a refresh doesn't fetch levels nobody can see
+      if(path) forgetExpanded(path);
     }
   }
 
@@ -1024,13 +2569,45 @@ APP_HTML = """
     return (i===0? Math.round(x) : x.toFixed(1))+" "+units[i];
   }
 
+  // Files this big go through the resumable session API, RESUMABLE_PARALLEL_PARTS parts at a time
+  const RESUMABLE_MIN_BYTES = 64 * 1024 * 1024;
+  const RESUMABLE_PARALLEL_PARTS = 4;
+  const RESUMABLE_MAX_RETRIES = 6;
+
+  const sleep = ms => new Promise(res => setTimeout(res, ms));
+
+  // files up to this size are hashed in the browser so the server can verify what it received
+  const CLIENT_HASH_MAX_BYTES = 64 * 1024 * 1024;
+
+  // Hex SHA-256 of a file, or "" when WebCrypto is unavailable (plain http off localhost)
+  // or the file is too big to read in one go; the server then just skips the check
+  async function sha256Hex(f){
+    if(!(window.crypto && crypto.subtle) || f.size > CLIENT_HASH_MAX_BYTES) return "";
+    try{
+      const digest = await crypto.subtle.digest("SHA-256", await f.arrayBuffer());
+      return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, "0")).join("");
+    }catch(e){
+      return "";
+    }
+  }
+
   async function uploadSingle(){
     const folder = document.getElementById("uploadFolder").value.trim();
     const f = document.getElementById("uploadFile").files[0];
     if(!f){ toast("Pick a file first.", false); return; }
 
+    if(f.size >= RESUMABLE_MIN_BYTES){
+      const ok = await uploadResumable(f, folder);
+      if(ok){
+        await refreshTree([folder || '']);
+        if(storageDataCache) await refreshStorage();
+      }
+      return;
+    }
+
     const form = new FormData();
     form.append("folder", folder);
+    form.append("sha256", await sha256Hex(f));
     form.append("file", f);
 
     const r = await apiFetch("/api/upload", {method:"POST", body: form});
@@ -1049,107 +2626,346 @@ APP_HTML = """
     if(storageDataCache) await refreshStorage();
   }
 
-  function calculateOptimalChunkSize(){
+  async function uploadSessionState(id){
+    const r = await apiFetch("/api/uploads/" + encodeURIComponent(id));
+    if(!r.ok) return null;
+    return r.json();
+  }
+
+  async function uploadResumable(f, folder){
+    // The session id is kept per (folder, file), so picking the same file again after a
+    // reload or a dropped connection only sends the parts the server doesn't have yet.
+    const key = "resumableUpload:" + JSON.stringify([folder, f.name, f.size, f.lastModified]);
+    let id = localStorage.getItem(key);
+    let state = id ? await uploadSessionState(id) : null;
+
+    if(!state){
+      const r = await apiFetch("/api/uploads", {
+        method: "POST",
+        headers: {"Content-Type": "application/json"},
+        body: JSON.stringify({folder, name: f.name, size: f.size})
+      });
+      if(r.status===401){ location.href="/login"; return false; }
+      let data=null; try{ data = await r.json(); }catch(e){}
+      if(!r.ok || !data || !data.ok){
+        toast((data && data.msg) ? data.msg : ("Upload failed: HTTP " + r.status), false);
+        return false;
+      }
+      state = data;
+      id = data.id;
+      localStorage.setItem(key, id);
+    }
+
+    const partSize = state.part_size;
+    const partLen = n => Math.min(partSize, f.size - n * partSize);
+    const done = new Set(state.parts);
+    const pending = [];
+    for(let n = 0; n * partSize < f.size; n++) if(!done.has(n)) pending.push(n);
+    let sent = [...done].reduce((a, n) => a + partLen(n), 0);
+    if(sent > 0) toast(`Resuming at ${fmtBytes(sent)} of ${fmtBytes(f.size)}`, true);
+
+    // Parts go up over several connections at once; each one retries on its own
+    let stopped = null;
+    const showProgress = () => setProgress(true, sent / Math.max(1, f.size) * 100,
+      `Uploading ${f.name} • ${fmtBytes(sent)} of ${fmtBytes(f.size)}`);
+    async function sendParts(){
+      while(pending.length && !stopped){
+        const n = pending.shift();
+        for(let failures = 0; ; ){
+          try{
+            const r = await apiFetch(`/api/uploads/${encodeURIComponent(id)}/parts/${n}`,
+              {method: "PUT", body: f.slice(n * partSize, n * partSize + partLen(n))});
+            if(r.status===401){ location.href="/login"; stopped = "not logged in"; return; }
+            if(r.ok) break;
+            let data=null; try{ data = await r.json(); }catch(e){}
+            const msg = (data && data.msg) ? data.msg : ("HTTP " + r.status);
+            if(r.status===404){ localStorage.removeItem(key); stopped = msg; return; }
+            throw new Error(msg);
+          }catch(e){
+            if(stopped) return;
+            if(++failures > RESUMABLE_MAX_RETRIES){ stopped = e.message; return; }
+            await sleep(Math.min(30000, 1000 * 2 ** failures));
+          }
+        }
+        sent += partLen(n);
+        showProgress();
+      }
+    }
+    showProgress();
+    await Promise.all(Array.from({length: RESUMABLE_PARALLEL_PARTS}, sendParts));
+    if(stopped){
+      setProgress(false, 0, "");
+      toast(`Upload stopped at ${fmtBytes(sent)}: ${stopped}. Pick the same file again to resume.`, false);
+      return false;
+    }
+
+    setProgress(true, 100, "Finalizing…");
+    const r = await apiFetch(`/api/uploads/${encodeURIComponent(id)}/finalize`, {method: "POST"});
+    let data=null; try{ data = await r.json(); }catch(e){}
+    setTimeout(()=>setProgress(false, 0, ""), 700);
+    if(!r.ok || !data || !data.ok){
+      toast((data && data.msg) ? data.msg : ("Upload failed: HTTP " + r.status), false);
+      return false;
+    }
+    localStorage.removeItem(key);
+    toast(data.msg || "Done.", true);
+    return true;
+  }
+
+  function describeFolderPick(){
     const files = document.getElementById("uploadDir").files;
-    const suggestionEl = document.getElementById("chunkSuggestion");
-    const chunkSizeEl = document.getElementById("chunkSize");
-    
+    const summaryEl = document.getElementById("chunkSuggestion");
     if(!files || !files.length){
-      suggestionEl.textContent = '';
+      summaryEl.textContent = '';
       return;
     }
-
-    const totalFiles = files.length;
     let totalSize = 0;
-    for(let i = 0; i < files.length; i++){
-      totalSize += files[i].size;
-    }
+    for(let i = 0; i < files.length; i++) totalSize += files[i].size;
+    summaryEl.textContent = `${files.length} files • ${fmtBytes(totalSize)}`;
+  }
 
-    // Calculate optimal chunk size based on:
-    // - Small folders (< 100 files): smaller chunks (50-80)
-    // - Medium folders (100-1000 files): medium chunks (100-150)
-    // - Large folders (> 1000 files): larger chunks (150-200)
-    // - Very large files: smaller chunks to avoid timeouts
-    const avgFileSize = totalSize / totalFiles;
-    let suggestedChunk = 120; // default
-
-    if(totalFiles < 100){
-      suggestedChunk = Math.max(30, Math.min(80, Math.floor(totalFiles / 2)));
-    }else if(totalFiles < 500){
-      suggestedChunk = Math.max(80, Math.min(150, Math.floor(totalFiles / 4)));
-    }else if(totalFiles < 1000){
-      suggestedChunk = Math.max(120, Math.min(200, Math.floor(totalFiles / 5)));
-    }else{
-      suggestedChunk = Math.max(150, Math.min(250, Math.floor(totalFiles / 6)));
-    }
+  const CHUNK_MAX_RETRIES = 5;
+  // Chunks are cut to a byte budget (and the max files per chunk), retuned after every
+  // chunk from the server's measured throughput so each round trip takes about CHUNK_TARGET_MS
+  const CHUNK_TARGET_MS = 5000;
+  const CHUNK_START_BYTES = 8 * 1024 * 1024;
+  const CHUNK_MIN_BYTES = 1024 * 1024;
+  const CHUNK_MAX_BYTES = 512 * 1024 * 1024;
+  // Folders of many small files go up as tar chunks: no per-file form parts, so one
+  // request can carry thousands of files
+  const TAR_MIN_FILES = 200;
+  const TAR_MAX_AVG_BYTES = 256 * 1024;
+  const TAR_MAX_FILES = 5000;
+
+  const utf8 = new TextEncoder();
+
+  function tarHeader(name, size, mtime, type){
+    const h = new Uint8Array(512);
+    const put = (str, off, len) => h.set(utf8.encode(str).subarray(0, len), off);
+    const oct = (n, off, len) => put(n.toString(8).padStart(len - 1, "0"), off, len - 1);
+    put(name, 0, 100);
+    oct(0o644, 100, 8);
+    oct(0, 108, 8);
+    oct(0, 116, 8);
+    oct(size, 124, 12);
+    oct(mtime, 136, 12);
+    h.fill(32, 148, 156);  // checksum is summed with its own field as spaces
+    put(type, 156, 1);
+    put("ustar\\0" + "00", 257, 8);
+    oct(h.reduce((a, b) => a + b, 0), 148, 7);
+    return h;
+  }
+
+  function tarPadding(size){
+    return new Uint8Array((512 - size % 512) % 512);
+  }
 
-    // Adjust for large average file size (reduce chunk size to avoid timeouts)
-    if(avgFileSize > 10 * 1024 * 1024){ // > 10MB average
-      suggestedChunk = Math.max(30, Math.floor(suggestedChunk * 0.6));
-    }else if(avgFileSize > 5 * 1024 * 1024){ // > 5MB average
-      suggestedChunk = Math.max(50, Math.floor(suggestedChunk * 0.75));
+  function paxRecords(fields){
+    // each record is "<len> key=value\\n", where <len> counts its own digits too
+    let out = "";
+    for(const [key, value] of Object.entries(fields)){
+      const body = ` ${key}=${value}\\n`;
+      const n = utf8.encode(body).length;
+      let len = n + String(n).length;
+      if(String(len).length > String(n).length) len = n + String(len).length;
+      out += len + body;
     }
+    return utf8.encode(out);
+  }
 
-    // Clamp to valid range
-    suggestedChunk = Math.max(10, Math.min(500, suggestedChunk));
+  // Uncompressed tar of [{name, file, sha256}] as a Blob; file contents are referenced, not copied
+  function tarBlob(entries){
+    const parts = [];
+    for(const {name, file, sha256} of entries){
+      const mtime = Math.floor((file.lastModified || Date.now()) / 1000);
+      const pax = {};
+      if(utf8.encode(name).length > 100 || /[^\\x20-\\x7e]/.test(name)) pax.path = name;
+      if(file.size > 0o77777777777) pax.size = String(file.size);
+      if(sha256) pax["JOEYSCLOUD.sha256"] = sha256;
+      if(Object.keys(pax).length){
+        const records = paxRecords(pax);
+        parts.push(tarHeader("PaxHeader", records.length, mtime, "x"), records, tarPadding(records.length));
+      }
+      parts.push(tarHeader(name.replace(/[^\\x20-\\x7e]/g, "_"), pax.size ? 0 : file.size, mtime, "0"), file, tarPadding(file.size));
+    }
+    parts.push(new Uint8Array(1024));
+    return new Blob(parts, {type: "application/x-tar"});
+  }
 
-    chunkSizeEl.value = suggestedChunk;
-    const totalChunks = Math.ceil(totalFiles / suggestedChunk);
-    suggestionEl.textContent = `Suggested: ${suggestedChunk} files/chunk (${totalChunks} chunks)`;
+  const MANIFEST_BATCH = 10000;
+
+  // Pre-flight: the server answers with the files it doesn't have (or has a different
+  // version of), so re-syncing a folder only sends what changed
+  async function filesToUpload(baseFolder, picked){
+    const need = [];
+    for(let start = 0; start < picked.length; start += MANIFEST_BATCH){
+      const batch = [];
+      for(let i = start; i < Math.min(picked.length, start + MANIFEST_BATCH); i++){
+        const f = picked[i];
+        batch.push({path: f.webkitRelativePath || f.name, size: f.size, mtime: f.lastModified / 1000});
+      }
+      const r = await apiFetch("/api/upload_manifest", {
+        method: "POST",
+        headers: {"Content-Type": "application/json"},
+        body: JSON.stringify({base_folder: baseFolder, files: batch})
+      });
+      let data=null; try{ data = await r.json(); }catch(e){}
+      if(!r.ok || !data || !data.ok) return Array.from(picked);  // can't tell, send everything
+      for(const i of data.need) need.push(picked[start + i]);
+    }
+    return need;
   }
 
   async function uploadFolderChunked(){
     const baseFolder = document.getElementById("uploadFolder").value.trim();
-    const files = document.getElementById("uploadDir").files;
-    if(!files || !files.length){ toast("Pick a folder first.", false); return; }
+    const picked = document.getElementById("uploadDir").files;
+    if(!picked || !picked.length){ toast("Pick a folder first.", false); return; }
+
+    setProgress(true, 0, `Checking ${picked.length} files…`);
+    const files = await filesToUpload(baseFolder, picked);
+    const unchanged = picked.length - files.length;
+    if(!files.length){
+      setProgress(false, 0, "");
+      toast(`All ${picked.length} files are already up to date.`, true);
+      return;
+    }
 
-    // files per chunk
-    let chunkSize = parseInt(document.getElementById("chunkSize").value || "120", 10);
-    if(isNaN(chunkSize) || chunkSize < 10) chunkSize = 120;
-    if(chunkSize > 500) chunkSize = 500;
+    // max files per chunk (each file is two form parts; the server allows 1000 by default)
+    let chunkSize = parseInt(document.getElementById("chunkSize").value || "200", 10);
+    if(isNaN(chunkSize) || chunkSize < 10) chunkSize = 200;
+    if(chunkSize > 450) chunkSize = 450;
+
+    // chunks in flight at once
+    let maxInFlight = parseInt(document.getElementById("chunkParallel").value || "3", 10);
+    if(isNaN(maxInFlight) || maxInFlight < 1) maxInFlight = 1;
+    if(maxInFlight > 8) maxInFlight = 8;
 
     const totalFiles = files.length;
-    const totalChunks = Math.ceil(totalFiles / chunkSize);
+    let totalBytes = 0;
+    for(let i = 0; i < totalFiles; i++) totalBytes += files[i].size;
+    const useTar = totalFiles >= TAR_MIN_FILES && totalBytes / totalFiles <= TAR_MAX_AVG_BYTES;
+    if(useTar) chunkSize = TAR_MAX_FILES;
+    // lets the server reuse the folders it already created for earlier chunks
+    const uploadId = Date.now().toString(36) + Math.random().toString(36).slice(2);
 
-    setProgress(true, 0, `Starting… (${totalFiles} files, ${totalChunks} chunks)`);
+    setProgress(true, 0, `Starting… (${totalFiles} files, ${fmtBytes(totalBytes)})`);
 
-    // IMPORTANT: sequential chunks (stable, less likely to die)
     let uploadedFiles = 0;
-
-    for(let chunkIndex=0; chunkIndex<totalChunks; chunkIndex++){
-      const start = chunkIndex * chunkSize;
-      const end = Math.min(totalFiles, start + chunkSize);
-
-      const form = new FormData();
-      form.append("base_folder", baseFolder);
-      form.append("chunk_index", String(chunkIndex));
-      form.append("total_chunks", String(totalChunks));
-
-      for(let i=start; i<end; i++){
-        const f = files[i];
-        form.append("files", f);
-        form.append("paths", f.webkitRelativePath || f.name);
+    let uploadedBytes = 0;
+    let doneChunks = 0;
+    let nextFile = 0;
+    let chunkIndex = 0;
+    let budget = CHUNK_START_BYTES;
+    let rateText = "";
+
+    function nextChunk(){
+      if(nextFile >= totalFiles) return null;
+      const start = nextFile;
+      let bytes = files[nextFile++].size;  // always at least one file, however big
+      while(nextFile < totalFiles && nextFile - start < chunkSize && bytes + files[nextFile].size <= budget){
+        bytes += files[nextFile++].size;
       }
+      return {index: chunkIndex++, start, end: nextFile, bytes};
+    }
 
-      const pct = (uploadedFiles / totalFiles) * 100;
-      setProgress(true, pct, `Uploading chunk ${chunkIndex+1}/${totalChunks} • files ${start+1}-${end} of ${totalFiles}`);
-
-      const r = await apiFetch("/api/upload_folder_chunk", {method:"POST", body: form});
-      if(r.status===401){ location.href="/login"; return; }
+    function tuneBudget(rttMs, data){
+      // round trip ≈ fixed overhead (latency, queueing) + bytes / server throughput
+      if(!data || !(data.throughput > 0) || !data.bytes) return;
+      const overhead = Math.max(0, rttMs - data.elapsed_ms);
+      const transferMs = Math.max(CHUNK_TARGET_MS / 4, CHUNK_TARGET_MS - overhead);
+      const ideal = data.throughput * transferMs / 1000;
+      budget = Math.max(CHUNK_MIN_BYTES, Math.min(CHUNK_MAX_BYTES, (budget + ideal) / 2));
+      rateText = ` • ${fmtBytes(data.throughput)}/s`;
+    }
 
-      let data=null; try{ data = await r.json(); }catch(e){}
+    // Several chunks are in flight at once. The limit shrinks by half whenever the
+    // server answers 429 (its upload slots are full) and grows back by one chunk per
+    // limit's worth of successes, so the pipeline settles where the server keeps up.
+    let limit = maxInFlight;
+    let inFlight = 0;
+    let stopped = null;
+
+    async function sendChunk(chunk){
+      let url = "/api/upload_folder_chunk?upload=" + uploadId, body;
+      const digests = [];
+      for(let i=chunk.start; i<chunk.end; i++) digests.push(await sha256Hex(files[i]));
+      if(useTar){
+        const entries = [];
+        for(let i=chunk.start; i<chunk.end; i++){
+          entries.push({name: files[i].webkitRelativePath || files[i].name, file: files[i], sha256: digests[i - chunk.start]});
+        }
+        url = "/api/upload_folder_tar?upload=" + uploadId + "&base_folder=" + encodeURIComponent(baseFolder);
+        body = tarBlob(entries);
+      }else{
+        body = new FormData();
+        body.append("base_folder", baseFolder);
+        body.append("chunk_index", String(chunk.index));
+        body.append("mtimes", JSON.stringify(files.slice(chunk.start, chunk.end).map(f => f.lastModified / 1000)));
+        body.append("sha256s", JSON.stringify(digests));
+        for(let i=chunk.start; i<chunk.end; i++){
+          const f = files[i];
+          body.append("paths", f.webkitRelativePath || f.name);  // path first: the server writes the file straight into place
+          body.append("files", f);
+        }
+      }
 
-      if(!r.ok){
-        setProgress(false, 0, "");
-        toast((data && data.msg) ? data.msg : ("Upload failed: HTTP " + r.status), false);
-        return;
+      for(let failures = 0; ; ){
+        let r = null, data = null;
+        const sentAt = performance.now();
+        try{
+          r = await apiFetch(url, {method:"POST", body});
+          try{ data = await r.json(); }catch(e){}
+        }catch(e){}
+        if(stopped) return;
+
+        if(r && r.ok){
+          limit = Math.min(maxInFlight, limit + 1 / Math.floor(limit));
+          tuneBudget(performance.now() - sentAt, data);
+          return;
+        }
+        if(r && r.status===401){ location.href="/login"; stopped = "not logged in"; return; }
+        if(r && r.status===429){
+          limit = Math.max(1, limit / 2);
+          await sleep((parseFloat(r.headers.get("Retry-After")) || 1) * 1000);
+          continue;
+        }
+        // network errors, server errors and checksum mismatches (422) are retried;
+        // anything else means the chunk is bad
+        if(r && r.status < 500 && r.status !== 422){ stopped = (data && data.msg) ? data.msg : ("Upload failed: HTTP " + r.status); return; }
+        if(++failures > CHUNK_MAX_RETRIES){ stopped = (data && data.msg) ? data.msg : "Upload failed: connection lost"; return; }
+        await sleep(Math.min(30000, 1000 * 2 ** failures));
       }
+    }
 
-      // server returns saved/skipped for this chunk
-      uploadedFiles = end;
+    await new Promise(resolve => {
+      function pump(){
+        while(!stopped && inFlight < Math.floor(limit)){
+          const chunk = nextChunk();
+          if(!chunk) break;
+          inFlight++;
+          setProgress(true, uploadedBytes / Math.max(1, totalBytes) * 100, `Uploading chunk ${chunk.index+1} • files ${chunk.start+1}-${chunk.end} of ${totalFiles}${rateText}`);
+          sendChunk(chunk).then(() => {
+            inFlight--;
+            if(!stopped){
+              uploadedFiles += chunk.end - chunk.start;
+              uploadedBytes += chunk.bytes;
+              doneChunks++;
+              setProgress(true, uploadedBytes / Math.max(1, totalBytes) * 100,
+                `${doneChunks} chunks done • ${uploadedFiles}/${totalFiles} files • ${fmtBytes(uploadedBytes)} of ${fmtBytes(totalBytes)}${rateText}`);
+            }
+            pump();
+          });
+        }
+        if(inFlight === 0) resolve();
+      }
+      pump();
+    });
 
-      const pct2 = (uploadedFiles / totalFiles) * 100;
-      setProgress(true, pct2, `Chunk ${chunkIndex+1}/${totalChunks} done • ${uploadedFiles}/${totalFiles} files`);
+    if(stopped){
+      setProgress(false, 0, "");
+      toast(stopped, false);
+      await refreshTree([baseFolder || '']);
+      return;
     }
 
     setProgress(true, 100, "Finalizing…");
@@ -1158,7 +2974,7 @@ APP_HTML = """
     await refreshTree([targetFolder]);
     setTimeout(()=>setProgress(false, 0, ""), 700);
 
-    toast("Folder uploaded successfully.", true);
+    toast(unchanged ? `Uploaded ${totalFiles} files (${unchanged} already up to date).` : "Folder uploaded successfully.", true);
     if(storageDataCache) await refreshStorage();
   }
 
@@ -1771,53 +3587,127 @@ def api_storage_stats():
 
     u = current_user()
     uid = int(u["id"])
-    rootp = user_root(uid)
+    is_admin = int(u["is_admin"]) == 1
     ensure_user_storage(uid)
-
-    user_used = dir_size_bytes(rootp)
-    user_files = count_files(rootp)
+    ensure_indexed(uid)
     ds = disk_stats()
 
-    out = {
-        "ok": True,
-        "user": {"used": user_used, "used_h": fmt_bytes(user_used), "files": user_files},
-        "disk": {
-            "total": ds["total"], "total_h": fmt_bytes(ds["total"]),
-            "used": ds["used"], "used_h": fmt_bytes(ds["used"]),
-            "free": ds["free"], "free_h": fmt_bytes(ds["free"]),
-        }
-    }
-
-    if int(u["is_admin"]) == 1:
+    # The payload only changes when a tree version moves or the disk figures change at
+    # the precision the UI shows them, so that is what the ETag is made of. The figures
+    # go in hashed: "18.2 GB" has a space, which isn't allowed in an ETag.
+    disk_tag = hashlib.sha1(f"{ds['used_h']}/{ds['free_h']}/{ds['total_h']}".encode("utf-8")).hexdigest()
+    etag = f"s{uid}-v{get_version(uid)}-{disk_tag}"
+    rescan = request.args.get("rescan") == "1"
+    if is_admin:
         conn = db()
         cur = conn.cursor()
-        cur.execute("SELECT id, username, is_admin FROM users ORDER BY is_admin DESC, username ASC")
-        users = []
-        for row in cur.fetchall():
-            ruid = int(row["id"])
-            rroot = user_root(ruid)
-            os.makedirs(rroot, exist_ok=True)
-            used = dir_size_bytes(rroot)
-            files = count_files(rroot)
-            users.append({
-                "username": row["username"],
-                "is_admin": bool(int(row["is_admin"]) == 1),
-                "used_h": fmt_bytes(used),
-                "files": files
-            })
+        cur.execute("SELECT COUNT(*) AS n, COALESCE(SUM(version), 0) AS v FROM tree_versions")
+        tv = cur.fetchone()
+        cur.execute("SELECT (SELECT COUNT(*) FROM users) AS users, (SELECT COUNT(*) FROM usage_ledger) AS ledger")
+        counts = cur.fetchone()
         conn.close()
-        out["admin"] = {"users": users}
+        etag += f"-a{counts['users']}-{tv['n']}-{tv['v']}"
+        # users still missing a ledger row are scanned until their scan has written one
+        rescan = rescan or counts["ledger"] < counts["users"]
+
+    def build():
+        user_used, user_files = get_usage(uid)
+        out = {
+            "ok": True,
+            "user": {"used": user_used, "used_h": fmt_bytes(user_used), "files": user_files},
+            "disk": ds
+        }
 
-    return jsonify(out)
+        if is_admin:
+            conn = db()
+            cur = conn.cursor()
+            cur.execute("SELECT id, username, is_admin FROM users ORDER BY is_admin DESC, username ASC")
+            rows = cur.fetchall()
+            conn.close()
+
+            usage = usage_for_users([int(r["id"]) for r in rows], rescan=request.args.get("rescan") == "1")
+            users = []
+            for row in rows:
+                us = usage[int(row["id"])]
+                users.append({
+                    "username": row["username"],
+                    "is_admin": bool(int(row["is_admin"]) == 1),
+                    "used_h": fmt_bytes(us["bytes"]),
+                    "files": us["files"],
+                    "stale": us["stale"]
+                })
+            out["admin"] = {"users": users}
+        return out
+
+    if rescan:
+        return jsonify(build())
+    return conditional_response(etag, build)
 
 @app.route("/api/file_tree")
 def api_file_tree():
+    """
+    Whole tree when called bare; with ?path=<folder>&depth=<n> (depth defaults to 1)
+    only that folder and n levels below it, each folder annotated with its entry count.
+    ?format=compact returns the same tree as compact_tree() columns. The bare nested
+    form is streamed by iter_tree_json() instead of being built in memory first.
+    Responses carry an ETag of the user's change version and honour If-None-Match.
+    """
     if not require_login():
         return jsonify({"ok": False, "msg": "not logged in"}), 401
     u = current_user()
     uid = int(u["id"])
     ensure_user_storage(uid)
-    return jsonify(folder_tree(user_root(uid), ""))
+    ensure_indexed(uid)
+    version = get_version(uid)
+
+    rel = request.args.get("path")
+    depth = request.args.get("depth")
+    compact = request.args.get("format") == "compact"
+    encode = compact_tree if compact else (lambda tree: tree)
+    fmt = "c" if compact else "n"
+    if rel is None and depth is None:
+        if compact:
+            # parallel arrays can't be emitted in one pass, so this form is built whole
+            return conditional_response(f"t{uid}-v{version}-{fmt}-full",
+                                        lambda: dict(encode(folder_tree(user_root(uid), "")), version=version))
+        return conditional_response(f"t{uid}-v{version}-{fmt}-full", lambda: app.response_class(
+            iter_tree_json(user_root(uid), "", {"version": version}), mimetype="application/json"))
+
+    # read-only listing: safe_join alone guards traversal, so names created outside the
+    # app (spaces etc.) stay reachable
+    rel = (rel or "").replace("\\", "/").strip("/")
+    try:
+        depth = max(1, int(depth or 1))
+        safe_join(user_root(uid), rel)
+    except ValueError:
+        return jsonify({"ok": False, "msg": "Invalid path or depth."}), 400
+    # the path goes in hashed: raw, a quote or a non-Latin-1 name would make a bad header
+    path_tag = hashlib.sha1(rel.encode("utf-8", "surrogateescape")).hexdigest()
+    return conditional_response(f"t{uid}-v{version}-{fmt}-d{depth}-{path_tag}",
+                                lambda: dict(encode(index_tree(uid, rel, depth)), version=version))
+
+@app.route("/api/file_tree/changes")
+def api_file_tree_changes():
+    """
+    Delta sync: ?since=<version> returns {"version", "changes": [...]} with the ops
+    journaled after that version, in order, or {"version", "reset": true} when the
+    client has to reload the tree instead.
+    """
+    if not require_login():
+        return jsonify({"ok": False, "msg": "not logged in"}), 401
+    u = current_user()
+    uid = int(u["id"])
+    try:
+        since = int(request.args.get("since", ""))
+    except ValueError:
+        since = -1
+    if not 0 <= since < 2 ** 63:  # SQLite INTEGER range
+        return jsonify({"ok": False, "msg": "Missing or invalid since."}), 400
+
+    version, changes = changes_since(uid, since)
+    if changes is None:
+        return jsonify({"ok": True, "version": version, "reset": True})
+    return jsonify({"ok": True, "version": version, "changes": changes})
 
 @app.route("/download")
 def download():
@@ -1837,9 +3727,95 @@ def download():
     if not os.path.isfile(abs_path):
         return "Not found", 404
 
-    folder = os.path.dirname(abs_path)
-    filename = os.path.basename(abs_path)
-    return send_from_directory(folder, filename, as_attachment=True)
+    if DOWNLOAD_OFFLOAD in ("nginx", "sendfile"):
+        return offload_response(abs_path)
+    st = os.stat(abs_path)
+    rel = os.path.relpath(abs_path, os.path.abspath(rootp)).replace(os.sep, "/")
+    return send_user_file(abs_path, st, *indexed_file(uid, rel, abs_path, st))
+
+@app.route("/download_folder")
+def download_folder():
+    """A folder (p, or all of the user's files) as a ZIP archive streamed while it is built."""
+    if not require_login():
+        return redirect("/login")
+
+    u = current_user()
+    uid = int(u["id"])
+    rootp = user_root(uid)
+
+    rel = request.args.get("p", "")
+    try:
+        abs_path = safe_join(rootp, rel)
+    except ValueError:
+        return "Invalid path", 400
+
+    if not os.path.isdir(abs_path):
+        return "Not found", 404
+
+    name = os.path.basename(abs_path) if abs_path != os.path.abspath(rootp) else u["username"]
+    return send_zip(walk_files(abs_path, name), name + ".zip")
+
+@app.route("/download_batch", methods=["POST"])
+def download_batch():
+    """
+    Several files and folders as one streamed ZIP.
+      form: paths = JSON list of paths (or a JSON body {"paths": [...]}), deflate (optional)
+    Entries are named relative to the closest folder holding the whole selection;
+    anything inside a selected folder is only included once.
+    """
+    if not require_login():
+        return redirect("/login")
+
+    u = current_user()
+    uid = int(u["id"])
+    rootp = os.path.abspath(user_root(uid))
+
+    try:
+        if request.is_json:
+            paths = (request.get_json(silent=True) or {}).get("paths")
+        else:
+            paths = json.loads(request.form.get("paths", "[]"))
+    except (AttributeError, ValueError):
+        paths = None
+    if not isinstance(paths, list) or not paths:
+        return "No paths given", 400
+
+    picked = {}  # abs_path -> is_dir
+    for rel in paths:
+        try:
+            abs_path = safe_join(rootp, str(rel))
+        except ValueError:
+            return "Invalid path", 400
+        if abs_path == rootp:
+            return "Invalid path", 400
+        if os.path.islink(abs_path) or not os.path.exists(abs_path):
+            return f"Not found: {rel}", 404
+        picked[abs_path] = os.path.isdir(abs_path)
+
+    def inside_picked_folder(abs_path):
+        parent = os.path.dirname(abs_path)
+        while parent != rootp:
+            if picked.get(parent):
+                return True
+            parent = os.path.dirname(parent)
+        return False
+
+    tops = sorted(p for p in picked if not inside_picked_folder(p))
+    base = os.path.commonpath([os.path.dirname(p) for p in tops])
+
+    def entries():
+        for abs_path in tops:
+            arcname = os.path.relpath(abs_path, base).replace(os.sep, "/")
+            if picked[abs_path]:
+                yield from walk_files(abs_path, arcname)
+            else:
+                yield abs_path, arcname, False
+
+    if len(tops) == 1:
+        name = os.path.basename(tops[0])
+    else:
+        name = os.path.basename(base) if base != rootp else u["username"]
+    return send_zip(entries(), name + ".zip")
 
 @app.route("/api/upload", methods=["POST"])
 def api_upload():
@@ -1851,28 +3827,57 @@ def api_upload():
     rootp = user_root(uid)
     ensure_user_storage(uid)
 
-    folder = sanitize_relpath((request.form.get("folder") or "").strip())
-    f = request.files.get("file")
-    if not f or not f.filename:
+    def open_file(field, filename, fields):
+        if field != "file" or not filename:
+            return None
+        if "folder" not in fields:
+            return StagedWrite(UPLOADS_DIR)
+        # "folder" comes first from the app, so the temp file sits where it will end up
+        return staged_write_in(rootp, sanitize_relpath(fields["folder"][0].strip()), {})
+
+    try:
+        fields, files = read_multipart(open_file)
+    except ValueError:
+        return jsonify({"ok": False, "msg": "Invalid folder path."})
+    except OSError as e:
+        return jsonify({"ok": False, "msg": f"Upload failed: {e}"})
+
+    uploads = [(filename, staged) for field, filename, staged in files if staged is not None]
+    for _, extra in uploads[1:]:
+        extra.discard()
+    if not uploads:
         return jsonify({"ok": False, "msg": "No file uploaded."})
+    filename, staged = uploads[0]
 
-    name = secure_filename(f.filename)
+    folder = sanitize_relpath((fields.get("folder", [""])[0]).strip())
+    name = secure_filename(filename)
     if not name:
+        staged.discard()
         return jsonify({"ok": False, "msg": "Bad filename."})
+    if not staged.matches(fields.get("sha256", [""])[0]):
+        staged.discard()
+        return jsonify({"ok": False, "msg": "Checksum mismatch: the file was damaged in transit. Please upload it again."}), 422
 
     try:
-        target_dir = safe_join(rootp, folder)
-        os.makedirs(target_dir, exist_ok=True)
-        target_path = os.path.join(target_dir, name)
-        f.save(target_path)
+        target_path, old_bytes, old_files = place_upload(staged, rootp, folder, name, {})
+        st = os.stat(target_path)
+
+        conn = db()
+        cur = conn.cursor()
+        record_writes(cur, uid, [(f"{folder}/{name}".strip("/"), st, old_bytes, old_files, staged.hash, st.st_mtime)])
+        conn.commit()
+        conn.close()
     except ValueError:
         return jsonify({"ok": False, "msg": "Invalid folder path."})
     except Exception as e:
         return jsonify({"ok": False, "msg": f"Upload failed: {e}"})
+    finally:
+        staged.discard()
 
     return jsonify({"ok": True, "msg": f"Uploaded: {(folder or 'root')} / {name}"})
 
 @app.route("/api/upload_folder_chunk", methods=["POST"])
+@upload_slot
 def api_upload_folder_chunk():
     """
     Chunk endpoint:
@@ -1881,7 +3886,15 @@ def api_upload_folder_chunk():
         chunk_index (optional, for UI)
         total_chunks (optional)
         files[] and paths[] (same length). paths[] = webkitRelativePath per file.
+        mtimes (optional) = JSON list of client mtimes in seconds, one per file.
+        sha256s (optional) = JSON list of hex SHA-256 digests, one per file ("" = unchecked).
+      query:
+        upload (optional) = id shared by all chunks of one folder upload, to reuse folders
+    Sending each path before its file lets the file be written straight into its folder.
+    The reply reports bytes saved, elapsed_ms spent on the request and the resulting
+    throughput (bytes/s), which the browser uses to size its next chunks.
     """
+    started = time.monotonic()
     if not require_login():
         return jsonify({"ok": False, "msg": "not logged in"}), 401
 
@@ -1890,53 +3903,501 @@ def api_upload_folder_chunk():
     rootp = user_root(uid)
     ensure_user_storage(uid)
 
-    base_folder = sanitize_relpath((request.form.get("base_folder") or "").strip())
-
-    files = request.files.getlist("files")
-    paths = request.form.getlist("paths")
+    dirs = upload_dir_cache(uid, request.args.get("upload", ""))
+
+    def target_of(fields, i, filename):
+        base_folder = sanitize_relpath((fields.get("base_folder", [""])[0]).strip())
+        paths = fields.get("paths", [])
+        return upload_target(base_folder, paths[i] if paths else filename)
+
+    seen = 0
+
+    def open_file(field, filename, fields):
+        nonlocal seen
+        if field != "files":
+            return None
+        i = seen
+        seen += 1
+        if not filename:
+            return None
+        if i >= len(fields.get("paths", [])):
+            return StagedWrite(UPLOADS_DIR)  # path not known yet; moved into place below
+        target = target_of(fields, i, filename)
+        if not target:
+            return None
+        return staged_write_in(rootp, target[0], dirs)
 
-    if not files:
-        return jsonify({"ok": False, "msg": "No files received in chunk."}), 400
+    try:
+        fields, parts = read_multipart(open_file)
+    except ValueError:
+        return jsonify({"ok": False, "msg": "Invalid path detected in upload."}), 400
+    except OSError as e:
+        return jsonify({"ok": False, "msg": f"Chunk upload failed: {e}"}), 500
 
-    if paths and len(paths) != len(files):
+    files = [(filename, staged) for field, filename, staged in parts if field == "files"]
+    paths = fields.get("paths", [])
+    try:
+        mtimes = json.loads(fields["mtimes"][0]) if "mtimes" in fields else []
+        digests = json.loads(fields["sha256s"][0]) if "sha256s" in fields else []
+    except ValueError:
+        mtimes, digests = None, None
+    # each one a JSON list with an entry per file, when sent at all
+    bad_lists = not all(isinstance(v, list) and (not v or len(v) == len(files)) for v in (mtimes, digests))
+
+    # a damaged file fails the whole chunk before anything is placed, so a retry starts clean
+    mismatched = [] if bad_lists else [i for i, (_, staged) in enumerate(files)
+                                       if staged is not None and i < len(digests) and not staged.matches(digests[i])]
+
+    if not files or (paths and len(paths) != len(files)) or bad_lists or mismatched:
+        for _, staged in files:
+            if staged is not None:
+                staged.discard()
+        if not files:
+            return jsonify({"ok": False, "msg": "No files received in chunk."}), 400
+        if bad_lists:
+            return jsonify({"ok": False, "msg": "Invalid mtimes or sha256s in chunk."}), 400
+        if mismatched:
+            return jsonify({"ok": False, "msg": f"Checksum mismatch on {len(mismatched)} file(s) in chunk. Try again.",
+                            "mismatched": mismatched}), 422
         return jsonify({"ok": False, "msg": "Upload mismatch (paths/files). Try again."}), 400
 
     saved = 0
     skipped = 0
+    written = []  # record_writes() entries
 
     try:
-        for i, f in enumerate(files):
-            if not f or not f.filename:
+        for i, (filename, staged) in enumerate(files):
+            target = target_of(fields, i, filename) if staged is not None else None
+            if not target:
                 skipped += 1
                 continue
+            rel_dir, rel_name = target
 
-            raw_rel = paths[i] if paths else f.filename
-            rel = sanitize_relpath(raw_rel)  # keeps subfolders safely
+            target_path, old_bytes, old_files = place_upload(staged, rootp, rel_dir, rel_name, dirs)
+            st, mtime = apply_client_mtime(target_path, mtimes[i] if i < len(mtimes) else None)
+            written.append((f"{rel_dir}/{rel_name}".strip("/"), st, old_bytes, old_files, staged.hash, mtime))
+            saved += 1
+
+    except ValueError:
+        return jsonify({"ok": False, "msg": "Invalid path detected in upload."}), 400
+    except Exception as e:
+        return jsonify({"ok": False, "msg": f"Chunk upload failed: {e}"}), 500
+    finally:
+        for _, staged in files:
+            if staged is not None:
+                staged.discard()
+        # one ledger/index transaction per chunk, including files saved before a failure
+        conn = db()
+        cur = conn.cursor()
+        record_writes(cur, uid, written)
+        conn.commit()
+        conn.close()
 
-            if base_folder:
-                rel = f"{base_folder}/{rel}".strip("/")
+    saved_bytes = sum(st.st_size for _, st, *_ in written)
+    elapsed = max(time.monotonic() - started, 0.001)
+    return jsonify({"ok": True, "msg": f"Chunk saved: {saved} files ({skipped} skipped)", "saved": saved, "skipped": skipped,
+                    "bytes": saved_bytes, "elapsed_ms": round(elapsed * 1000), "throughput": round(saved_bytes / elapsed)})
 
-            rel_dir = os.path.dirname(rel).replace("\\", "/")
-            rel_name = os.path.basename(rel)
+MANIFEST_LOOKUP_BATCH = 500  # paths per SELECT ... IN (...), under SQLite's variable limit
 
-            rel_name = secure_filename(rel_name) or rel_name
-            if not rel_name:
-                skipped += 1
-                continue
+@app.route("/api/upload_manifest", methods=["POST"])
+def api_upload_manifest():
+    """
+    Pre-flight for a folder upload.
+      json: base_folder (optional), files: [{path, size, mtime, hash (optional)}]
+    Replies with `need`, the indexes of entries missing from the file index or different
+    from it; the browser uploads only those. A hash is compared when both sides have
+    one, otherwise size and mtime, the latter in whole seconds as tar headers carry it.
+    """
+    if not require_login():
+        return jsonify({"ok": False, "msg": "not logged in"}), 401
 
-            target_dir = safe_join(rootp, rel_dir)
-            os.makedirs(target_dir, exist_ok=True)
+    uid = int(current_user()["id"])
+    data = request.get_json(silent=True) or {}
+    entries = data.get("files") if isinstance(data, dict) else None
+    if not isinstance(entries, list):
+        return jsonify({"ok": False, "msg": "Bad manifest."}), 400
+    base_folder = sanitize_relpath(str(data.get("base_folder") or "").strip())
 
-            target_path = os.path.join(target_dir, rel_name)
-            f.save(target_path)
-            saved += 1
+    targets = []  # index path per entry, None if it has no usable path
+    for entry in entries:
+        try:
+            rel_dir, rel_name = upload_target(base_folder, str(entry["path"]))
+            targets.append(f"{rel_dir}/{rel_name}".strip("/"))
+        except (KeyError, TypeError, ValueError):
+            targets.append(None)
+
+    ensure_indexed(uid)
+    conn = db()
+    cur = conn.cursor()
+    # primary-key lookups for just this batch's paths, not the user's whole index
+    wanted = sorted({t for t in targets if t})
+    have = {}
+    for i in range(0, len(wanted), MANIFEST_LOOKUP_BATCH):
+        batch = wanted[i:i + MANIFEST_LOOKUP_BATCH]
+        cur.execute(
+            f"SELECT path, type, size, mtime, hash FROM files WHERE user_id=? AND path IN ({','.join('?' * len(batch))})",
+            (uid, *batch)
+        )
+        have.update((r["path"], r) for r in cur.fetchall())
+    conn.close()
+
+    need = []
+    for i, (entry, target) in enumerate(zip(entries, targets)):
+        try:
+            row = have.get(target) if target else None
+            if not row or row["type"] != "file" or row["size"] != int(entry["size"]):
+                need.append(i)
+            elif entry.get("hash") and row["hash"]:
+                if str(entry["hash"]).lower() != row["hash"]:
+                    need.append(i)
+            elif int(row["mtime"]) != int(float(entry["mtime"])):
+                need.append(i)
+        except (AttributeError, KeyError, TypeError, ValueError, OverflowError):
+            need.append(i)  # let the upload itself accept or skip it
+
+    return jsonify({"ok": True, "need": need})
+
+@app.route("/api/upload_folder_tar", methods=["POST"])
+@upload_slot
+def api_upload_folder_tar():
+    """
+    Folder upload as one uncompressed tar (the request body), extracted as it streams in.
+      query: base_folder (optional), upload (optional, as on the chunk endpoint)
+    Member paths get the same sanitizing as paths[] on the chunk endpoint; regular files
+    are written with their tar mtime, folders are created as needed and links or devices
+    are skipped. A member whose pax header carries JOEYSCLOUD.sha256 is checked against it
+    and not saved if it differs; the reply is then 422 listing those paths. Otherwise
+    replies like /api/upload_folder_chunk.
+    """
+    started = time.monotonic()
+    if not require_login():
+        return jsonify({"ok": False, "msg": "not logged in"}), 401
+
+    u = current_user()
+    uid = int(u["id"])
+    rootp = user_root(uid)
+    ensure_user_storage(uid)
+
+    base_folder = sanitize_relpath((request.args.get("base_folder") or "").strip())
+    dirs = upload_dir_cache(uid, request.args.get("upload", ""))
+
+    saved = 0
+    skipped = 0
+    written = []  # record_writes() entries
+    mismatched = []
+
+    try:
+        with tarfile.open(fileobj=request.stream, mode="r|") as tar:
+            for member in tar:
+                if member.isdir():
+                    continue  # created along with the files inside it
+                if not member.isreg():
+                    skipped += 1  # links, devices
+                    continue
+
+                target = upload_target(base_folder, member.name)
+                if not target:
+                    skipped += 1
+                    continue
+                rel_dir, rel_name = target
+
+                staged = staged_write_in(rootp, rel_dir, dirs)
+                try:
+                    shutil.copyfileobj(tar.extractfile(member), staged, UPLOAD_WRITE_BYTES)
+                    if not staged.matches(member.pax_headers.get("JOEYSCLOUD.sha256")):
+                        mismatched.append(member.name)
+                        continue
+                    target_path, old_bytes, old_files = place_upload(staged, rootp, rel_dir, rel_name, dirs)
+                finally:
+                    staged.discard()
+                st, mtime = apply_client_mtime(target_path, member.mtime)
+                written.append((f"{rel_dir}/{rel_name}".strip("/"), st, old_bytes, old_files, staged.hash, mtime))
+                saved += 1
 
     except ValueError:
         return jsonify({"ok": False, "msg": "Invalid path detected in upload."}), 400
+    except tarfile.TarError as e:
+        return jsonify({"ok": False, "msg": f"Bad archive: {e}"}), 400
     except Exception as e:
-        return jsonify({"ok": False, "msg": f"Chunk upload failed: {e}"}), 500
+        return jsonify({"ok": False, "msg": f"Archive upload failed: {e}"}), 500
+    finally:
+        # one ledger/index transaction per archive, including files saved before a failure
+        conn = db()
+        cur = conn.cursor()
+        record_writes(cur, uid, written)
+        conn.commit()
+        conn.close()
+
+    if mismatched:
+        return jsonify({"ok": False, "msg": f"Checksum mismatch on {len(mismatched)} file(s) in archive. Try again.",
+                        "mismatched": mismatched}), 422
+
+    saved_bytes = sum(st.st_size for _, st, *_ in written)
+    elapsed = max(time.monotonic() - started, 0.001)
+    return jsonify({"ok": True, "msg": f"Archive saved: {saved} files ({skipped} skipped)", "saved": saved, "skipped": skipped,
+                    "bytes": saved_bytes, "elapsed_ms": round(elapsed * 1000), "throughput": round(saved_bytes / elapsed)})
+
+@app.route("/api/uploads", methods=["POST"])
+def api_upload_session_create():
+    """
+    Start a resumable upload of one file.
+      json: folder, name, size
+    The bytes then go up either in order as PUT /api/uploads/<id>?offset=N, each
+    continuing at the offset the server last reported, or in any order and in
+    parallel as PUT /api/uploads/<id>/parts/<n> of part_size bytes each.
+    GET /api/uploads/<id> reports both after a dropped connection, and
+    POST /api/uploads/<id>/finalize moves the file into place.
+    """
+    if not require_login():
+        return jsonify({"ok": False, "msg": "not logged in"}), 401
+
+    u = current_user()
+    uid = int(u["id"])
+    rootp = user_root(uid)
+    ensure_user_storage(uid)
+
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({"ok": False, "msg": "Bad request."}), 400
+    folder = sanitize_relpath(str(data.get("folder") or "").strip())
+    name = secure_filename(str(data.get("name") or ""))
+    if not name:
+        return jsonify({"ok": False, "msg": "Bad filename."}), 400
+    try:
+        size = int(data.get("size"))
+    except (TypeError, ValueError, OverflowError):
+        size = -1
+    if size < 0:
+        return jsonify({"ok": False, "msg": "Bad file size."}), 400
+    if size > app.config["MAX_CONTENT_LENGTH"]:
+        return jsonify({"ok": False, "msg": "File too large."}), 413
+    try:
+        safe_join(rootp, folder)
+    except ValueError:
+        return jsonify({"ok": False, "msg": "Invalid folder path."}), 400
+
+    expire_upload_sessions()
+    session_id = secrets.token_urlsafe(18)
+    now = int(time.time())
+    conn = db()
+    cur = conn.cursor()
+    # the limits below are checked and the session recorded as one step, so concurrent
+    # creates can't all pass against the same free space
+    cur.execute("BEGIN IMMEDIATE")
+    cur.execute("SELECT COUNT(*) FROM upload_sessions WHERE user_id=?", (uid,))
+    if cur.fetchone()[0] >= UPLOAD_SESSIONS_PER_USER:
+        conn.rollback()
+        conn.close()
+        return jsonify({"ok": False, "msg": "Too many unfinished uploads. Finish or cancel one first."}), 429
+    if shutil.disk_usage(UPLOADS_DIR).free - reserved_upload_bytes(cur) < size:
+        conn.rollback()
+        conn.close()
+        return jsonify({"ok": False, "msg": "Not enough free disk space."}), 507
+    cur.execute(
+        "INSERT INTO upload_sessions (id, user_id, folder, name, size, received, created_at, updated_at) VALUES (?, ?, ?, ?, ?, 0, ?, ?)",
+        (session_id, uid, folder, name, size, now, now)
+    )
+    conn.commit()
+    conn.close()
+
+    try:
+        fd = os.open(upload_part_path(session_id), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            os.ftruncate(fd, size)  # sparse: disk is only taken as data arrives
+        finally:
+            os.close(fd)
+    except OSError as e:
+        drop_upload_session(session_id)
+        return jsonify({"ok": False, "msg": f"Upload failed: {e}"}), 500
+
+    return jsonify({"ok": True, "id": session_id, "offset": 0, "size": size,
+                    "part_size": UPLOAD_PART_BYTES, "parts": []})
+
+@app.route("/api/uploads/<session_id>", methods=["GET"])
+def api_upload_session_status(session_id):
+    if not require_login():
+        return jsonify({"ok": False, "msg": "not logged in"}), 401
+
+    row = get_upload_session(int(current_user()["id"]), session_id)
+    if not row:
+        return jsonify({"ok": False, "msg": "Upload not found."}), 404
+    return jsonify(upload_session_state(row))
+
+@app.route("/api/uploads/<session_id>", methods=["PUT"])
+def api_upload_session_put(session_id):
+    """Raw request body = file bytes starting at ?offset=, which must be the current offset."""
+    if not require_login():
+        return jsonify({"ok": False, "msg": "not logged in"}), 401
+
+    row = get_upload_session(int(current_user()["id"]), session_id)
+    if not row:
+        return jsonify({"ok": False, "msg": "Upload not found."}), 404
+    try:
+        offset = int(request.args.get("offset", ""))
+    except ValueError:
+        return jsonify({"ok": False, "msg": "Bad offset."}), 400
+    if offset != row["received"]:
+        # e.g. a retry of a range that did land; the client continues from our offset
+        return jsonify({"ok": False, "msg": "Offset mismatch.", "offset": row["received"], "size": row["size"]}), 409
+
+    received = offset
+    overflow = False
+    try:
+        fd = os.open(upload_part_path(session_id), os.O_WRONLY)
+    except FileNotFoundError:
+        # expired, aborted or finalized since the lookup above
+        return jsonify({"ok": False, "msg": "Upload not found."}), 404
+    try:
+        while True:
+            block = request.stream.read(UPLOAD_WRITE_BYTES)
+            if not block:
+                break
+            if received + len(block) > row["size"]:
+                overflow = True
+                break
+            view = memoryview(block)
+            while view:
+                n = os.pwrite(fd, view, received)
+                received += n
+                view = view[n:]
+    except ClientDisconnected:
+        pass  # keep what arrived; the client asks for the offset and resumes from there
+    finally:
+        # only advertise bytes that are on disk, so a resume after a crash can't skip any
+        getattr(os, "fdatasync", os.fsync)(fd)
+        os.close(fd)
+        conn = db()
+        cur = conn.cursor()
+        cur.execute(
+            "UPDATE upload_sessions SET received=?, updated_at=? WHERE id=? AND received=?",
+            (received, int(time.time()), session_id, offset)
+        )
+        conn.commit()
+        conn.close()
+
+    if overflow:
+        return jsonify({"ok": False, "msg": "Data past the end of the file.", "offset": received, "size": row["size"]}), 400
+    return jsonify({"ok": True, "offset": received, "size": row["size"]})
+
+@app.route("/api/uploads/<session_id>/parts/<int:part>", methods=["PUT"])
+def api_upload_session_part(session_id, part):
+    """Raw request body = part `part` of the file: part_size bytes, fewer for the last one."""
+    if not require_login():
+        return jsonify({"ok": False, "msg": "not logged in"}), 401
+
+    row = get_upload_session(int(current_user()["id"]), session_id)
+    if not row:
+        return jsonify({"ok": False, "msg": "Upload not found."}), 404
+    if part >= upload_part_count(row["size"]):
+        return jsonify({"ok": False, "msg": "Bad part number."}), 400
+
+    start = part * UPLOAD_PART_BYTES
+    expected = min(UPLOAD_PART_BYTES, row["size"] - start)
+    pos = start
+    try:
+        fd = os.open(upload_part_path(session_id), os.O_WRONLY)
+    except FileNotFoundError:
+        # expired, aborted or finalized since the lookup above
+        return jsonify({"ok": False, "msg": "Upload not found."}), 404
+    try:
+        while True:
+            block = request.stream.read(UPLOAD_WRITE_BYTES)
+            if not block:
+                break
+            if pos + len(block) > start + expected:
+                # never write into the next part's range
+                return jsonify({"ok": False, "msg": f"Part {part} should be {expected} bytes."}), 400
+            view = memoryview(block)
+            while view:
+                n = os.pwrite(fd, view, pos)
+                pos += n
+                view = view[n:]
+        if pos - start != expected:
+            return jsonify({"ok": False, "msg": f"Part {part} should be {expected} bytes."}), 400
+        getattr(os, "fdatasync", os.fsync)(fd)
+    except ClientDisconnected:
+        return jsonify({"ok": False, "msg": "Part interrupted."}), 400
+    finally:
+        os.close(fd)
+
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("INSERT OR IGNORE INTO upload_parts (session_id, part) VALUES (?, ?)", (session_id, part))
+    cur.execute("UPDATE upload_sessions SET updated_at=? WHERE id=?", (int(time.time()), session_id))
+    conn.commit()
+    conn.close()
+
+    return jsonify({"ok": True, "part": part})
+
+@app.route("/api/uploads/<session_id>/finalize", methods=["POST"])
+def api_upload_session_finalize(session_id):
+    if not require_login():
+        return jsonify({"ok": False, "msg": "not logged in"}), 401
+
+    uid = int(current_user()["id"])
+    rootp = user_root(uid)
+    row = get_upload_session(uid, session_id)
+    if not row:
+        return jsonify({"ok": False, "msg": "Upload not found."}), 404
+    if not upload_session_complete(row):
+        state = upload_session_state(row)
+        state.update(ok=False, msg="Upload incomplete.")
+        return jsonify(state), 409
+
+    folder, name = row["folder"], row["name"]
+    try:
+        target_dir = safe_join(rootp, folder)
+        target_path = os.path.join(target_dir, name)
+        if os.path.isdir(target_path):
+            return jsonify({"ok": False, "msg": "A folder with that name already exists."}), 409
+        os.makedirs(target_dir, exist_ok=True)
+        old_bytes, old_files = path_usage(target_path) if os.path.isfile(target_path) else (0, 0)
+        file_hash = None
+        if DEDUP_STORAGE:
+            # Parts arrive out of order, so this one is hashed in a read pass at the end.
+            # A PUT still in flight can write into the partial file after that, so the
+            # blob is a fresh copy hashed on the way through, never the partial's inode.
+            with open(upload_part_path(session_id), "rb") as f:
+                staged = StagedWrite(target_dir)
+                try:
+                    for block in iter(lambda: f.read(UPLOAD_WRITE_BYTES), b""):
+                        staged.write(block)
+                    os.remove(upload_part_path(session_id))  # a concurrent finalize gets the 404
+                    staged.commit(target_path)
+                finally:
+                    staged.discard()
+            file_hash = staged.hash
+        else:
+            os.replace(upload_part_path(session_id), target_path)
+        st = os.stat(target_path)
+
+        conn = db()
+        cur = conn.cursor()
+        record_writes(cur, uid, [(f"{folder}/{name}".strip("/"), st, old_bytes, old_files, file_hash, st.st_mtime)])
+        cur.execute("DELETE FROM upload_sessions WHERE id=?", (session_id,))
+        cur.execute("DELETE FROM upload_parts WHERE session_id=?", (session_id,))
+        conn.commit()
+        conn.close()
+    except ValueError:
+        return jsonify({"ok": False, "msg": "Invalid folder path."}), 400
+    except FileNotFoundError:
+        # a concurrent finalize or abort got the partial file first
+        return jsonify({"ok": False, "msg": "Upload not found."}), 404
+    except Exception as e:
+        return jsonify({"ok": False, "msg": f"Upload failed: {e}"}), 500
+
+    return jsonify({"ok": True, "msg": f"Uploaded: {(folder or 'root')} / {name}"})
 
-    return jsonify({"ok": True, "msg": f"Chunk saved: {saved} files ({skipped} skipped)", "saved": saved, "skipped": skipped})
+@app.route("/api/uploads/<session_id>", methods=["DELETE"])
+def api_upload_session_abort(session_id):
+    if not require_login():
+        return jsonify({"ok": False, "msg": "not logged in"}), 401
+
+    if not get_upload_session(int(current_user()["id"]), session_id):
+        return jsonify({"ok": False, "msg": "Upload not found."}), 404
+    drop_upload_session(session_id)
+    return jsonify({"ok": True, "msg": "Upload cancelled."})
 
 @app.route("/api/mkdir", methods=["POST"])
 def api_mkdir():
@@ -1966,6 +4427,14 @@ def api_mkdir():
             return jsonify({"ok": False, "msg": f"Parent folder does not exist: {os.path.dirname(p)}"}), 404
         
         os.makedirs(target_path, exist_ok=False)
+
+        conn = db()
+        cur = conn.cursor()
+        version = bump_version(cur, uid)
+        for d in index_ensure_dirs(cur, uid, p):
+            record_change(cur, uid, version, "add", d, kind="folder")
+        conn.commit()
+        conn.close()
     except ValueError:
         return jsonify({"ok": False, "msg": "Invalid path."}), 400
     except FileExistsError:
@@ -1995,12 +4464,25 @@ def api_delete():
         if not os.path.exists(abs_path):
             return jsonify({"ok": False, "msg": f"File or folder not found: {p}"}), 404
         
+        if not os.path.isdir(abs_path) and not os.path.isfile(abs_path):
+            return jsonify({"ok": False, "msg": f"Path exists but is neither a file nor folder: {p}"}), 400
+
+        freed_bytes, freed_files = path_usage(abs_path)
         if os.path.isdir(abs_path):
             shutil.rmtree(abs_path)
-        elif os.path.isfile(abs_path):
-            os.remove(abs_path)
         else:
-            return jsonify({"ok": False, "msg": f"Path exists but is neither a file nor folder: {p}"}), 400
+            os.remove(abs_path)
+
+        forget_upload_dirs(uid)
+        conn = db()
+        cur = conn.cursor()
+        hashes = indexed_hashes(cur, uid, p) if DEDUP_STORAGE else []
+        adjust_usage(cur, uid, -freed_bytes, -freed_files)
+        index_remove(cur, uid, p)
+        record_change(cur, uid, bump_version(cur, uid), "remove", p)
+        conn.commit()
+        conn.close()
+        release_blobs(hashes)
     except ValueError:
         return jsonify({"ok": False, "msg": "Invalid path."}), 400
     except Exception as e:
@@ -2043,6 +4525,15 @@ def api_rename():
             return jsonify({"ok": False, "msg": f"A {item_type} with this name already exists: {safe_new}"}), 409
 
         os.rename(abs_path, new_abs)
+        forget_upload_dirs(uid)
+
+        conn = db()
+        cur = conn.cursor()
+        new_rel = f"{rel_parent(p)}/{safe_new}".strip("/")
+        index_rename(cur, uid, p, new_rel)
+        record_change(cur, uid, bump_version(cur, uid), "rename", p, new_path=new_rel)
+        conn.commit()
+        conn.close()
     except ValueError:
         return jsonify({"ok": False, "msg": "Invalid path."}), 400
     except Exception as e:
@@ -2052,7 +4543,10 @@ def api_rename():
 
 # ---------------- Main ----------------
 
+# At import, not under __main__: gunicorn and other WSGI servers only import `app`
+init_db()
+start_usage_reconciler()
+
 if __name__ == "__main__":
-    init_db()
     debug_mode = os.environ.get("FLASK_DEBUG", "false").lower() == "true"
     app.run(host=HOST, port=PORT, debug=debug_mode)